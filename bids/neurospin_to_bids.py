@@ -5,7 +5,7 @@ import pandas as pd
 from ast import literal_eval
 import json
 import glob as glob
-from collections import OrderedDict
+from collections import deque
 import shutil
 import subprocess
 from pathlib import Path
@@ -19,7 +19,17 @@ from mne_bids import write_raw_bids, make_dataset_description
 from itertools import combinations
 import time
 import argparse
-import re
+import fnmatch
+import hashlib
+import tempfile
+import uuid
+import struct
+import zlib
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
 
 
 NEUROSPIN_DATABASES = {
@@ -29,6 +39,53 @@ NEUROSPIN_DATABASES = {
     'meg' : '/neurospin/acquisition/neuromag/data',
 }
 
+BIDS_CATALOG_FILE = '.bids_catalog.json'
+BIDS_CATALOG_VERSION = 1
+
+IMPORT_MANIFEST_FILE = '.import_manifest.jsonl'
+
+DEFACE_CHECKSUMS_FILE = '.deface_checksums.json'
+
+BIDS_VALIDATION_CACHE_FILE = '.bids_validation.json'
+
+# Seconds during which an index of the acquisition database is trusted
+ACQUISITION_INDEX_TTL = 600
+
+# Index of the acquisition database:
+# date directory -> (indexing time, date directory mtime,
+#                    {NIP directory: mtime},
+#                    {NIP directory: {series number: [series directories]}})
+_acquisition_index = {}
+
+# Information of the MEG acquisition days (see meg_subject_info):
+# MEG directory -> (reading time, directory mtime, information)
+_meg_subject_info = {}
+
+# Semaphore limiting the series read at the same time from the acquisition
+# server by all the importations of the process (see
+# set_acquisition_server_jobs), None for no limit
+_acquisition_server_slots = None
+
+# Options of the dcm2niibatch yaml file
+DCM2NII_OPTIONS = dict(isGz='false',
+                       isFlipY='false',
+                       isVerbose='false',
+                       isCreateBIDS='true',
+                       isOnlySingleFile='false')
+
+# FSL installation used by pydeface (see deface_images)
+FSL_DIR = "/i2bm/local/fsl/bin/"
+
+# Size of the chunks of a nifti file compressed in parallel (see gzip_file)
+GZIP_CHUNK_SIZE = 1 << 20
+
+# dcm2niix command line flags of the dcm2niibatch options. isFlipY has no
+# command line counterpart, the orientation is kept in the nifti affine.
+DCM2NIIX_FLAGS = dict(isGz='-z',
+                      isVerbose='-v',
+                      isCreateBIDS='-b',
+                      isOnlySingleFile='-s')
+
 
 
 def yes_no(question_to_be_answered):
@@ -42,23 +99,31 @@ def yes_no(question_to_be_answered):
             print("Please respond with 'y/n'\n")
 
 def file_manager_default_file(main_path, filter_list, file_tag,
-                              file_type='*', allow_other_fields=True):
+                              file_type='*', allow_other_fields=True,
+                              catalog=None):
     """Path to the most specific file with respect to optional filters.
 
     Each filter is a list [key, value]. Like [sub, 01] or [ses, 02].
 
     Following BIDS standard files can be of the form
     [key-value_]...[key-value_]file_tag.file_type.
+
+    catalog is a catalog of main_path (see load_bids_catalog), built in
+    memory if not given.
     """
     filters = []
     for n in list(reversed(range(1, len(filter_list) + 1))):
         filters += combinations(filter_list, n)
     filters += [[]]
+    # One scan of main_path serves every filter combination
+    if catalog is None:
+        catalog = load_bids_catalog(main_path, save=False)
     for filt in filters:
         found = get_bids_files(main_path,
                                sub_folder=False, file_type=file_type,
                                file_tag=file_tag, filters=filt,
-                               allow_other_fields=allow_other_fields)
+                               allow_other_fields=allow_other_fields,
+                               catalog=catalog)
         if found:
             return found[0]
     return None
@@ -84,15 +149,21 @@ def file_reference(img_path):
 
 def get_bids_files(main_path, file_tag='*', file_type='*', sub_id='*',
                    file_folder='*', filters=[], ref=False, sub_folder=True,
-                   allow_other_fields=True):
+                   allow_other_fields=True, catalog=None):
     """Return files following bids spec
 
     Filters are of the form (key, value). Only one filter per key allowed.
     A file for which a filter do not apply will be discarded.
+
+    If a catalog of main_path is given (see load_bids_catalog) it is queried
+    instead of the file system.
     """
     if sub_folder:
-        files = os.path.join(main_path, 'sub-*', 'ses-*')
-        if glob.glob(files):
+        if catalog is not None:
+            has_sessions = catalog['index']['has_sessions']
+        else:
+            has_sessions = glob.glob(os.path.join(main_path, 'sub-*', 'ses-*'))
+        if has_sessions:
             files = os.path.join(main_path, 'sub-%s' % sub_id, 'ses-*',
                                  file_folder, 'sub-%s*_%s.%s' %
                                  (sub_id, file_tag, file_type))
@@ -103,7 +174,18 @@ def get_bids_files(main_path, file_tag='*', file_type='*', sub_id='*',
     else:
         files = os.path.join(main_path, '*%s.%s' % (file_tag, file_type))
 
-    files = glob.glob(files)
+    if catalog is not None:
+        entities = list(filters)
+        if sub_folder and not glob.has_magic(sub_id):
+            entities.append(('sub', sub_id))
+        if not glob.has_magic(file_tag):
+            entities.append(('file_tag', file_tag))
+        if not glob.has_magic(file_type):
+            entities.append(('file_type', file_type))
+        files = [file_ for file_ in query_bids_catalog(catalog, entities)
+                 if _match_glob(file_, files)]
+    else:
+        files = glob.glob(files)
     files.sort()
     if filters:
         if not allow_other_fields:
@@ -123,49 +205,245 @@ def get_bids_files(main_path, file_tag='*', file_type='*', sub_id='*',
         return [ref_file['file_path'] for ref_file in files]
 
 
+def _match_glob(path, pattern):
+    """glob-like matching of a path: wildcards never cross a separator"""
+    path_parts = Path(path).parts
+    pattern_parts = Path(pattern).parts
+    if len(path_parts) != len(pattern_parts):
+        return False
+    return all(fnmatch.fnmatchcase(part, pattern_part) for part, pattern_part
+               in zip(path_parts, pattern_parts))
+
+
+def _write_text_atomic(file_path, text):
+    """Write text in a temporary file next to file_path then rename it"""
+    file_dir, file_name = os.path.split(file_path)
+    tmp_path = os.path.join(file_dir, f'.{file_name}.{uuid.uuid4().hex}.tmp')
+    try:
+        # 'x' mode: permissions follow the umask, unlike tempfile
+        with open(tmp_path, 'x') as fid:
+            fid.write(text)
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _write_json_atomic(json_path, data, **kwargs):
+    """Write data in a temporary file next to json_path then rename it"""
+    _write_text_atomic(json_path, json.dumps(data, **kwargs))
+
+
+def _scan_bids_catalog(main_path, old_dirs):
+    """Walk main_path, listing again only directories whose mtime changed.
+
+    Hidden files and directories are ignored.
+    """
+    dirs = {}
+    to_scan = ['']
+    while to_scan:
+        rel_dir = to_scan.pop()
+        abs_dir = os.path.join(main_path, rel_dir)
+        try:
+            mtime = os.stat(abs_dir).st_mtime
+        except OSError:
+            continue
+        entry = old_dirs.get(rel_dir)
+        if entry is None or entry['mtime'] != mtime:
+            entry = {'mtime': mtime, 'subdirs': [], 'files': {}}
+            with os.scandir(abs_dir) as it:
+                for dir_entry in it:
+                    if dir_entry.name.startswith('.'):
+                        continue
+                    if dir_entry.is_dir():
+                        entry['subdirs'].append(dir_entry.name)
+                    elif dir_entry.is_file():
+                        stat = dir_entry.stat()
+                        entry['files'][dir_entry.name] = [stat.st_size,
+                                                          stat.st_mtime]
+            entry['subdirs'].sort()
+        dirs[rel_dir] = entry
+        to_scan.extend(os.path.join(rel_dir, subdir)
+                       for subdir in entry['subdirs'])
+    return dirs
+
+
+def _bids_catalog_listing(dirs):
+    """Sub-directories and files of a catalog, without the directory mtimes.
+
+    Writing a hidden file (the catalog itself, the import manifest...)
+    changes the mtime of its directory but not its listing.
+    """
+    return {rel_dir: (entry['subdirs'], entry['files'])
+            for rel_dir, entry in dirs.items()}
+
+
+def _index_bids_catalog(main_path, dirs):
+    """Inverted index (key, value) -> set of file paths of a catalog.
+
+    Keys are the fields parsed by file_reference plus 'file_tag' and
+    'file_type'. Files which do not follow the bids naming are only
+    reachable through a query without filter.
+    """
+    index = {'files': set(), 'entities': {}, 'has_sessions': False}
+    for rel_dir, entry in dirs.items():
+        parts = Path(rel_dir).parts
+        if (len(parts) == 2 and parts[0].startswith('sub-') and
+                parts[1].startswith('ses-')):
+            index['has_sessions'] = True
+        for file_name in entry['files']:
+            file_path = os.path.join(main_path, rel_dir, file_name)
+            index['files'].add(file_path)
+            try:
+                reference = file_reference(file_path)
+            except ValueError:
+                continue
+            keys = [(field, reference[field])
+                    for field in reference['fields_ordered']]
+            keys += [('file_tag', reference['file_tag']),
+                     ('file_type', reference['file_type'])]
+            for key in keys:
+                index['entities'].setdefault(key, set()).add(file_path)
+    return index
+
+
+def load_bids_catalog(main_path, catalog_path=None, update=True, save=True):
+    """Catalog of the files of main_path, persisted on disk.
+
+    The catalog records for each directory its mtime, its sub-directories
+    and the size and mtime of its files. When updated, only directories
+    whose mtime changed are listed again; the sizes and mtimes of files are
+    refreshed when their directory changes. The catalog is saved again only
+    when a listing changed, so that the mtime changes due to hidden files,
+    such as the catalog itself, do not rewrite it at each load.
+
+    By default the catalog is stored in main_path/.bids_catalog.json.
+    Use query_bids_catalog or get_bids_files(..., catalog=catalog) to
+    search it.
+    """
+    if catalog_path is None:
+        catalog_path = os.path.join(main_path, BIDS_CATALOG_FILE)
+    dirs = {}
+    if os.path.isfile(catalog_path):
+        with open(catalog_path) as fid:
+            stored = json.load(fid)
+        if stored.get('version') == BIDS_CATALOG_VERSION:
+            dirs = stored['dirs']
+    if update:
+        new_dirs = _scan_bids_catalog(main_path, dirs)
+        if (save and os.path.isdir(main_path) and
+                _bids_catalog_listing(new_dirs) !=
+                _bids_catalog_listing(dirs)):
+            _write_json_atomic(catalog_path, {'version': BIDS_CATALOG_VERSION,
+                                              'dirs': new_dirs})
+        dirs = new_dirs
+    return {'main_path': main_path, 'dirs': dirs,
+            'index': _index_bids_catalog(main_path, dirs)}
+
+
+def query_bids_catalog(catalog, filters=()):
+    """Files of a catalog matching all (key, value) filters.
+
+    Keys are file_reference fields ('sub', 'ses', 'task', ...) or
+    'file_tag' and 'file_type'. The cost depends on the number of matches,
+    not on the size of the dataset.
+    """
+    index = catalog['index']
+    if not filters:
+        return sorted(index['files'])
+    candidates = sorted((index['entities'].get(tuple(filt), set())
+                         for filt in filters), key=len)
+    return sorted(candidates[0].intersection(*candidates[1:]))
+
+
+# ioctl request cloning a file on copy-on-write file systems (linux)
+FICLONE = 0x40049409
+
+
+def _clone_file(src, dst):
+    """Copy-on-write copy of src, the data blocks are shared with src"""
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+
+def _copy_event_file(src, dst, mode='copy', check_hash=False):
+    """Copy, hard link or clone src to dst unless dst is already identical.
+
+    Files are identical if they have the same size and mtime (copies keep
+    the mtime) or, with check_hash, the same content. If the file system
+    can not link or clone, the file is copied.
+    """
+    if os.path.exists(dst):
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+        if src_stat.st_size == dst_stat.st_size and (
+                src_stat.st_mtime == dst_stat.st_mtime or
+                (check_hash and _file_sha1(src) == _file_sha1(dst))):
+            return 'skipped'
+        os.remove(dst)
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'linked'
+        except OSError:
+            pass
+    elif mode == 'reflink':
+        try:
+            _clone_file(src, dst)
+            return 'cloned'
+        except (OSError, ImportError):
+            if os.path.exists(dst):
+                os.remove(dst)
+    shutil.copy2(src, dst)
+    return 'copied'
+
+
 def bids_copy_events(behav_path='exp_info/recorded_events', data_root_path='',
-                     dataset_name=None):
+                     dataset_name=None, mode='copy', nb_workers=None,
+                     check_hash=False, pool=None):
+    """Copy the events files of recorded_events into the dataset.
+
+    behav_path follows the bids structure of the dataset:
+    sub-<label>[/ses-<label>]/func/sub-<label>_..._events.tsv.
+    Files are copied concurrently on a thread pool of nb_workers (or on
+    pool if given) and files already identical in the dataset are skipped
+    (see _copy_event_file).
+    mode is 'copy', 'hardlink' (no copy, the dataset and behav_path must be
+    on the same volume) or 'reflink' (copy-on-write clone, btrfs/xfs).
+
+    Returns {destination file: 'copied', 'linked', 'cloned' or 'skipped'}.
+    """
     dataset_name, data_path = get_bids_default_path(data_root_path, dataset_name)
-    #print(os.path.join(data_root_path, behav_path, 'sub-*', 'ses-*'))
-    if glob.glob(os.path.join(data_root_path, behav_path, 'sub-*', 'ses-*')):
-        sub_folders = glob.glob(os.path.join(behav_path, 'sub-*', 'ses-*',
+    behav_root = os.path.join(data_root_path, behav_path)
+    if glob.glob(os.path.join(behav_root, 'sub-*', 'ses-*')):
+        sub_folders = glob.glob(os.path.join(behav_root, 'sub-*', 'ses-*',
                                              'func'))
     else:
-        #print(os.path.join(data_root_path, behav_path,'sub-*', 'func'))
-        sub_folders = glob.glob(os.path.join(data_root_path, behav_path,
-                                             'sub-*', 'func'))
+        sub_folders = glob.glob(os.path.join(behav_root, 'sub-*', 'func'))
 
     # raise warning if no folder is found in recorded events
     if not sub_folders:
         print('****  BIDS IMPORTATION WARMING: NO EVENTS FILE')
-    else:
-        for sub_folder in sub_folders:
-            #file_path = sub_folder.replace(behav_path + '/', '')
-            file_path = sub_folder
-            for file_name in os.listdir(os.path.join(sub_folder)):
-
-#                dest_directory = os.path.join(data_path, file_path)
-#                if not os.path.exists(dest_directory):
-#                    os.makedirs(dest_directory)
-
-                file_ext = []
-                last = ''
-                root, last = os.path.split(sub_folder)
-                while last != 'recorded_events':
-                    if last == '':
-                        break
-                    file_ext.append(last)
-                    sub_folder = root
-                    root, last = os.path.split(sub_folder)
-
-                list_tmp = []
-                elements_path = [[item, '/'] for item in reversed(file_ext)]
-                elements_path = [(list_tmp.append(item[0]),
-                                  list_tmp.append(item[1]))
-                                 for item in elements_path]
-                ext = ''.join(list_tmp)
-                shutil.copyfile(os.path.join(file_path, file_name),
-                                os.path.join(data_path, ext, file_name))
+        return {}
+
+    files_to_copy = []
+    for sub_folder in sub_folders:
+        dest_directory = os.path.join(data_path,
+                                      os.path.relpath(sub_folder, behav_root))
+        if not os.path.exists(dest_directory):
+            os.makedirs(dest_directory)
+        files_to_copy += [(os.path.join(sub_folder, file_name),
+                           os.path.join(dest_directory, file_name))
+                          for file_name in os.listdir(sub_folder)]
+    with _worker_pool(pool, ThreadPoolExecutor, nb_workers) as pool:
+        jobs = [pool.submit(_copy_event_file, src, dst, mode, check_hash)
+                for src, dst in files_to_copy]
+        return {dst: job.result()
+                for (_, dst), job in zip(files_to_copy, jobs)}
 
 
 def get_bids_path(data_root_path='', subject_id='01', folder='',
@@ -219,8 +497,27 @@ def get_bids_default_path(data_root_path='', dataset_name=None):
     return(dataset_name, os.path.join(data_root_path, dataset_name))
 
 
+def load_import_config(config_path):
+    """Answers to the questions of the importation, from a yaml/json file.
+
+    See bids/import_config_template.yaml for the keys. With a config, the
+    importation never asks anything: missing keys take their default value.
+    """
+    with open(config_path) as fid:
+        config = yaml.safe_load(fid)
+    return config or {}
+
+
+def _answer(config, key, question, default=False):
+    """Answer to a yes/no question, asked only if there is no config"""
+    if config is None:
+        return yes_no(question)
+    return bool(config.get(key, default))
+
+
 def bids_init_dataset(data_root_path='', dataset_name=None,
-                      dataset_description=dict(), readme='', changes=''):
+                      dataset_description=dict(), readme='', changes='',
+                      config=None):
     """Create directories and files missing to follow bids.
 
     Files and folders already created will be left untouched.
@@ -237,6 +534,11 @@ def bids_init_dataset(data_root_path='', dataset_name=None,
 
     CHANGES follow CPAN standards
 
+    With a config (see load_import_config), nothing is asked: existing files
+    are overwritten only if overwrite_dataset_description, overwrite_changes
+    or overwrite_readme are true, and the files are filled with the
+    dataset_description (dict of make_dataset_description arguments),
+    changes and readme values.
     """
     
     # CHECK DATASET RESPOSITORY
@@ -248,10 +550,13 @@ def bids_init_dataset(data_root_path='', dataset_name=None,
     description_file = os.path.exists(os.path.join(dataset_name_path, 'dataset_description.json'))
     overwrite_datadesc_file = True
     if description_file:
-        overwrite_datadesc_file = yes_no('\nA dataset_description.json is already exising, do you want to overwrite ? ')
+        overwrite_datadesc_file = _answer(config, 'overwrite_dataset_description',
+                                          '\nA dataset_description.json is already exising, do you want to overwrite ? ')
     if overwrite_datadesc_file or not description_file:
-        data_descrip = yes_no('\nDo you want to create or overwrite the dataset_description.json ? (y/n)')
-        if data_descrip :
+        description = None
+        if config is not None:
+            description = config.get('dataset_description')
+        elif yes_no('\nDo you want to create or overwrite the dataset_description.json ? (y/n)'):
             print('\nIf you do not know all information: pass and edit the file later.')
             name = input("\nTape the name of this BIDS dataset: ").lower()
             authors = input("\nA list of authors like [‘a’, ‘b’, ‘c’]: ").lower()
@@ -260,13 +565,16 @@ def bids_init_dataset(data_root_path='', dataset_name=None,
             funding = input('\nList of sources of funding (e.g., grant numbers). Must be a list of strings or a single comma separated string like [‘a’, ‘b’, ‘c’] : ')
             references_and_links = input("\nList of references to publication that contain information on the dataset, or links. Must be a list of strings or a single comma separated string like [‘a’, ‘b’, ‘c’] :")
             doi = input('\nThe DOI for the dataset : ')
-            make_dataset_description(dataset_name_path, name=name, 
-                                     data_license=None, authors=authors, 
-                                     acknowledgements=str(acknowledgements), 
-                                     how_to_acknowledge=how_to_acknowledge, 
-                                     funding=str(funding), 
-                                     references_and_links=references_and_links, 
-                                     doi=doi, verbose=False)
+            description = dict(name=name,
+                               data_license=None, authors=authors,
+                               acknowledgements=str(acknowledgements),
+                               how_to_acknowledge=how_to_acknowledge,
+                               funding=str(funding),
+                               references_and_links=references_and_links,
+                               doi=doi)
+        if description:
+            make_dataset_description(dataset_name_path, verbose=False,
+                                     **description)
         else:
             print("\nYou may update the README file later on. A README file by default has been created.")
             make_dataset_description(dataset_name_path, name=dataset_name)
@@ -277,12 +585,16 @@ def bids_init_dataset(data_root_path='', dataset_name=None,
     changes_file_exist = os.path.exists(changes_file)
     overwrite_changes_file = True
     if changes_file_exist :
-        overwrite_changes_file = yes_no('\nA CHANGES file is already existing, do you want to overwrite ? ')
+        overwrite_changes_file = _answer(config, 'overwrite_changes',
+                                         '\nA CHANGES file is already existing, do you want to overwrite ? ')
     
     if overwrite_changes_file or not changes_file_exist :
-        changes = yes_no('\nDo you want to create/overwrite the CHANGES file ? (y/n)')
-        if changes:
+        changes_input = None
+        if config is not None:
+            changes_input = config.get('changes')
+        elif yes_no('\nDo you want to create/overwrite the CHANGES file ? (y/n)'):
             changes_input= input("Tape your text: ")
+        if changes_input is not None:
             with open(changes_file, 'w', encoding="utf-8") as fid:
                 fid.write(str(changes_input))
         
@@ -292,17 +604,1222 @@ def bids_init_dataset(data_root_path='', dataset_name=None,
     readme_file_exist = os.path.exists(readme_file)
     overwrite_readme_file = True
     if readme_file_exist:
-        overwrite_readme_file = yes_no('\nA README file is already existing, do you want to overwrite ? ')
+        overwrite_readme_file = _answer(config, 'overwrite_readme',
+                                        '\nA README file is already existing, do you want to overwrite ? ')
         
     if overwrite_readme_file or not readme_file_exist:
-        readme = yes_no('\nDo you want to create/complete the README file ? (y/n)')
-        if not readme:
-            readme_input = "TO BE COMPLETED BY THE USER"
-        else:
+        readme_input = "TO BE COMPLETED BY THE USER"
+        if config is not None:
+            readme_input = config.get('readme') or readme_input
+        elif yes_no('\nDo you want to create/complete the README file ? (y/n)'):
             readme_input= input("Tape your text: ")
         with open(readme_file, 'w') as fid:
-            fid.write('test')
+            fid.write(readme_input)
+
+
+
+def set_acquisition_server_jobs(nb_jobs=None):
+    """Limit the number of series read at the same time from the
+    acquisition server, for all the importations of the process.
+
+    nb_jobs None removes the limit.
+    """
+    global _acquisition_server_slots
+    _acquisition_server_slots = (None if nb_jobs is None
+                                 else threading.BoundedSemaphore(nb_jobs))
+
+
+@contextmanager
+def _acquisition_server():
+    """Hold a slot of the acquisition server while reading a series"""
+    slots = _acquisition_server_slots
+    if slots is None:
+        yield
+    else:
+        with slots:
+            yield
+
 
+@contextmanager
+def _worker_pool(pool, pool_class, nb_workers=None):
+    """pool if given (shared between importations), else a new pool of
+    pool_class with nb_workers, shut down on exit"""
+    if pool is not None:
+        yield pool
+    else:
+        with pool_class(max_workers=nb_workers) as pool:
+            yield pool
+
+
+def _process_pool(max_workers=None):
+    """Process pool whose workers are started by a fork server.
+
+    The workers do not inherit the threads, locks and environment of the
+    importation running when the first job is submitted. The fork server
+    imports the __main__ module again in each worker: scripts using the
+    functions running on these pools (bids_acquisition_download,
+    bids_batch_download, deface_images, convert_meg_runs,
+    bids_validate_files) must call them under
+    if __name__ == '__main__'.
+    """
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context('forkserver'))
+
+
+def _dcm2niix_command(file_to_convert, options=DCM2NII_OPTIONS):
+    """dcm2niix command converting one entry of the dcm2niibatch file list.
+
+    Existing files are overwritten (-w 1) instead of being kept next to
+    results renamed with a suffix.
+    """
+    cmd = ['dcm2niix', '-w', '1']
+    for option, flag in DCM2NIIX_FLAGS.items():
+        if option in options:
+            cmd += [flag, 'y' if options[option] == 'true' else 'n']
+    cmd += ['-f', file_to_convert['filename'],
+            '-o', file_to_convert['out_dir'],
+            file_to_convert['in_dir']]
+    return cmd
+
+
+def _remove_dcm2niix_outputs(file_to_convert):
+    """Remove the <out_dir>/<filename>.* files of a conversion"""
+    pattern = os.path.join(glob.escape(file_to_convert['out_dir']),
+                           glob.escape(file_to_convert['filename']) + '.*')
+    for output in glob.glob(pattern):
+        os.remove(output)
+
+
+def _dcm2niix_run(file_to_convert, options=DCM2NII_OPTIONS, timeout=None,
+                  retries=0):
+    """Run dcm2niix on one series, retrying on failure or timeout.
+
+    The files left by a previous attempt are removed before each attempt,
+    and after the last one if the series could not be converted.
+    """
+    cmd = _dcm2niix_command(file_to_convert, options)
+    status = dict(file_to_convert, status='failed', attempts=0, message='')
+    # The DICOM files are read from the acquisition server
+    with _acquisition_server():
+        start = time.time()
+        while status['attempts'] <= retries:
+            status['attempts'] += 1
+            _remove_dcm2niix_outputs(file_to_convert)
+            try:
+                process = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT,
+                                         universal_newlines=True,
+                                         timeout=timeout)
+            except subprocess.TimeoutExpired:
+                status['status'] = 'timeout'
+                status['message'] = f"no result after {timeout} s"
+                continue
+            except OSError as error:
+                status['message'] = str(error)
+                break
+            if process.returncode == 0:
+                status['status'] = 'converted'
+                status['message'] = ''
+                break
+            status['status'] = 'failed'
+            status['message'] = process.stdout.strip().split('\n')[-1]
+        if status['status'] != 'converted':
+            _remove_dcm2niix_outputs(file_to_convert)
+        status['seconds'] = time.time() - start
+    return status
+
+
+def dcm2nii_convert(files_to_convert, options=DCM2NII_OPTIONS,
+                    nb_workers=None, timeout=None, retries=0, callback=None,
+                    pool=None):
+    """Convert DICOM series to nifti with one dcm2niix process per series.
+
+    files_to_convert is the file list of the dcm2niibatch yaml file, i.e.
+    dicts with 'in_dir', 'out_dir' and 'filename' keys. At most nb_workers
+    conversions run at the same time (by default the number of CPUs), or
+    they run on pool, a thread pool shared with other importations. A
+    conversion is killed after timeout seconds and run again up to retries
+    times.
+
+    Returns one status dict per series, with the keys of the file list
+    plus 'status' ('converted', 'failed' or 'timeout'), 'attempts',
+    'seconds' and 'message'. callback, if given, is called with each
+    status as soon as the series is done.
+    """
+    statuses = []
+    if not files_to_convert:
+        return statuses
+    with _worker_pool(pool, ThreadPoolExecutor,
+                      nb_workers or os.cpu_count()) as pool:
+        jobs = [pool.submit(_dcm2niix_run, file_to_convert, options, timeout,
+                            retries)
+                for file_to_convert in files_to_convert]
+        for job in as_completed(jobs):
+            status = job.result()
+            if callback is not None:
+                callback(status)
+            statuses.append(status)
+    return statuses
+
+
+def dicom_series_fingerprint(series_path, content_hash=False):
+    """Fingerprint of the files of a DICOM series directory.
+
+    Number of files, total size, latest mtime and a sha1 of the file names.
+    With content_hash, a sha1 of the file contents is added (slow on the
+    acquisition server, all the files are read).
+    """
+    files = []
+    with os.scandir(series_path) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime))
+    files.sort()
+    names = hashlib.sha1()
+    for name, _, _ in files:
+        names.update(name.encode() + b'\0')
+    fingerprint = {'nb_files': len(files),
+                   'size': sum(size for _, size, _ in files),
+                   'mtime': max([mtime for _, _, mtime in files], default=0),
+                   'names': names.hexdigest()}
+    if content_hash:
+        content = hashlib.sha1()
+        for name, _, _ in files:
+            with open(os.path.join(series_path, name), 'rb') as fid:
+                for block in iter(lambda: fid.read(1 << 20), b''):
+                    content.update(block)
+        fingerprint['sha1'] = content.hexdigest()
+    return fingerprint
+
+
+def _output_stem(output_path):
+    """Output path without its extension (.nii, .nii.gz, .json ...)"""
+    output_dir, output_name = os.path.split(output_path)
+    return os.path.join(output_dir, output_name.split('.', 1)[0])
+
+
+def _output_fingerprints(dataset_path, series):
+    """{path: [size, mtime]} of the files of the series, i.e. series.*"""
+    outputs = {}
+    for path in glob.glob(glob.escape(os.path.join(dataset_path, series))
+                          + '.*'):
+        stat = os.stat(path)
+        outputs[os.path.relpath(path, dataset_path)] = [stat.st_size,
+                                                        stat.st_mtime]
+    return outputs
+
+
+def load_import_manifest(dataset_path):
+    """Series imported in a dataset, replayed from its manifest journal.
+
+    The manifest dataset_path/.import_manifest.jsonl has one line per
+    imported series, the last line of a series wins. A line cut by a crash
+    is ignored. Series are identified by their output path without
+    extension, relative to dataset_path, e.g. 'sub-01/anat/sub-01_T1w'.
+    """
+    manifest = {}
+    manifest_path = os.path.join(dataset_path, IMPORT_MANIFEST_FILE)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as fid:
+            for line in fid:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                manifest[entry['series']] = entry
+    return manifest
+
+
+def record_import_manifest(dataset_path, manifest, series, source,
+                           source_fingerprint):
+    """Record an imported series with the fingerprint of its outputs.
+
+    The entry is appended to the manifest journal at once, so that an
+    interrupted import resumes after the last recorded series.
+    """
+    entry = {'series': series, 'source': source,
+             'source_fingerprint': source_fingerprint,
+             'outputs': _output_fingerprints(dataset_path, series)}
+    manifest[series] = entry
+    with open(os.path.join(dataset_path, IMPORT_MANIFEST_FILE), 'ab+') as fid:
+        # Do not append to a line cut by a crash
+        if fid.seek(0, os.SEEK_END) > 0:
+            fid.seek(-1, os.SEEK_END)
+            if fid.read(1) != b'\n':
+                fid.write(b'\n')
+        fid.write((json.dumps(entry) + '\n').encode())
+    return entry
+
+
+def refresh_import_manifest(dataset_path, manifest, output_path):
+    """Record the new fingerprints of the outputs of an imported series.
+
+    To be called after an output is modified on purpose (defacing, json
+    descriptors), otherwise the series would be considered changed.
+    """
+    series = os.path.relpath(_output_stem(output_path), dataset_path)
+    if series in manifest:
+        entry = manifest[series]
+        record_import_manifest(dataset_path, manifest, series,
+                               entry['source'], entry['source_fingerprint'])
+
+
+def compact_import_manifest(dataset_path, manifest):
+    """Rewrite the manifest journal with one line per series"""
+    _write_text_atomic(os.path.join(dataset_path, IMPORT_MANIFEST_FILE),
+                       ''.join(json.dumps(entry) + '\n'
+                               for entry in manifest.values()))
+
+
+def is_series_imported(dataset_path, manifest, series, source_fingerprint):
+    """True if the series was imported from the same source files and its
+    outputs were not modified since."""
+    entry = manifest.get(series)
+    if entry is None or entry['source_fingerprint'] != source_fingerprint:
+        return False
+    return (bool(entry['outputs']) and
+            entry['outputs'] == _output_fingerprints(dataset_path, series))
+
+
+def _file_sha1(file_path):
+    """sha1 of the content of a file"""
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as fid:
+        for block in iter(lambda: fid.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _deface_templates():
+    """Paths of the pydeface template and facemask"""
+    template_dir = ("/neurospin/unicog/protocols/IRMf/Unicogfmri/BIDS/"
+                    "unicog-dev/bids/template_deface")
+    if os.path.isdir(template_dir):
+        return (os.path.join(template_dir, 'mean_reg2mean.nii.gz'),
+                os.path.join(template_dir, 'facemask.nii.gz'))
+    return (resource_filename(Requirement.parse("unicog"),
+                              "bids/template_deface/mean_reg2mean.nii.gz"),
+            resource_filename(Requirement.parse("unicog"),
+                              "bids/template_deface/facemask.nii.gz"))
+
+
+def _deface_run(file_to_deface, template, facemask, fsl_dir=None):
+    """Deface one image in place.
+
+    Returns the sha1 of the defaced image and the seconds spent in the
+    worker, without the time waiting in the pool. The FSL environment of
+    fsl_dir is set in the worker itself, which may have been started by
+    another importation.
+    """
+    start = time.time()
+    if fsl_dir is not None:
+        os.environ['FSLDIR'] = fsl_dir
+        os.environ['FSLOUTPUTTYPE'] = "NIFTI_PAIR"
+        if fsl_dir not in os.environ['PATH'].split(os.pathsep):
+            os.environ['PATH'] = fsl_dir + os.pathsep + os.environ['PATH']
+    pdu.deface_image(infile=file_to_deface,
+                     outfile=file_to_deface,
+                     facemask=facemask,
+                     template=template,
+                     force=True)
+    return _file_sha1(file_to_deface), time.time() - start
+
+
+def deface_images(files_to_deface, template=None, facemask=None,
+                  checksums_path=None, nb_workers=None, callback=None,
+                  pool=None, fsl_dir=None):
+    """Deface images in place with pydeface, in parallel.
+
+    The template and facemask (by default those of _deface_templates) are
+    copied once to a local temporary directory shared by the nb_workers
+    processes (or the processes of pool, a process pool shared with other
+    importations), instead of being read from the server for every image.
+
+    checksums_path is a json file of the checksums of the defaced images:
+    an image whose checksum is recorded there is already defaced and is
+    skipped. The checksums of newly defaced images are added to it.
+    fsl_dir, if given, is the FSL installation used by the workers.
+
+    Returns one status dict per image with keys 'file', 'status'
+    ('defaced', 'skipped' or 'failed'), 'seconds' (spent defacing in the
+    worker, 0 if it failed) and 'message'. callback, if given, is called
+    with each status as soon as the image is done.
+    The worker processes import __main__ again: call it under
+    if __name__ == '__main__' (see _process_pool).
+    """
+    if template is None or facemask is None:
+        template, facemask = _deface_templates()
+    checksums = {}
+    if checksums_path is not None and os.path.isfile(checksums_path):
+        with open(checksums_path) as fid:
+            checksums = json.load(fid)
+
+    statuses = []
+
+    def done(status):
+        if callback is not None:
+            callback(status)
+        statuses.append(status)
+
+    to_deface = []
+    for file_to_deface in files_to_deface:
+        key = os.path.abspath(file_to_deface)
+        if (key in checksums and os.path.isfile(file_to_deface) and
+                checksums[key] == _file_sha1(file_to_deface)):
+            done({'file': file_to_deface, 'status': 'skipped', 'seconds': 0.,
+                  'message': 'already defaced'})
+        else:
+            to_deface.append(file_to_deface)
+    if not to_deface:
+        return statuses
+
+    with tempfile.TemporaryDirectory(prefix='deface_') as local_dir, \
+            _worker_pool(pool, _process_pool,
+                         nb_workers or os.cpu_count()) as pool:
+        template = shutil.copy(template, local_dir)
+        facemask = shutil.copy(facemask, local_dir)
+        jobs = {pool.submit(_deface_run, file_to_deface, template, facemask,
+                            fsl_dir): file_to_deface
+                for file_to_deface in to_deface}
+        for job in as_completed(jobs):
+            file_to_deface = jobs[job]
+            status = {'file': file_to_deface, 'status': 'defaced',
+                      'seconds': 0., 'message': ''}
+            try:
+                (checksums[os.path.abspath(file_to_deface)],
+                 status['seconds']) = job.result()
+            except Exception as error:
+                status['status'] = 'failed'
+                status['message'] = str(error)
+            else:
+                if checksums_path is not None:
+                    _write_json_atomic(checksums_path, checksums, indent=1)
+            done(status)
+    return statuses
+
+
+def _nifti_path(nii_path):
+    """Path of the .nii file, or of its compressed .nii.gz if only this one
+    exists"""
+    if not os.path.exists(nii_path) and os.path.exists(nii_path + '.gz'):
+        return nii_path + '.gz'
+    return nii_path
+
+
+def _deflate_chunk(chunk, level, zdict, last):
+    """Raw deflate of a chunk, ended by a sync flush unless it is the last
+    chunk of the file. zdict is the end of the previous chunk."""
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(chunk) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def gzip_file(src, dst, level=6, nb_workers=None, pool=None,
+              chunk_size=GZIP_CHUNK_SIZE):
+    """Compress src into the gzip file dst, in parallel like pigz.
+
+    src is read by chunks of chunk_size, deflated concurrently on a thread
+    pool of nb_workers (or on pool if given), each chunk primed with the
+    last 32 kB of the previous one. The chunks are written in order as a
+    single gzip member, readable by gzip, nibabel or any zlib reader.
+    level is the zlib compression level, 1 (fast) to 9 (small).
+
+    Returns (bytes read, bytes written).
+    """
+    nb_workers = nb_workers or os.cpu_count()
+    xfl = 2 if level == 9 else 4 if level == 1 else 0
+    crc, size = 0, 0
+    # Chunks being compressed, bounded to keep the memory used low
+    pending = deque()
+    with _worker_pool(pool, ThreadPoolExecutor, nb_workers) as pool, \
+            open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        # gzip header: magic, deflate, no flags, mtime, xfl, unknown OS
+        fout.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0,
+                               int(os.stat(src).st_mtime) & 0xffffffff,
+                               xfl, 255))
+        zdict = b''
+        chunk = fin.read(chunk_size)
+        while True:
+            next_chunk = fin.read(chunk_size)
+            last = not next_chunk
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            pending.append(pool.submit(_deflate_chunk, chunk, level, zdict,
+                                       last))
+            zdict = chunk[-32768:]
+            if len(pending) >= 2 * nb_workers:
+                fout.write(pending.popleft().result())
+            if last:
+                break
+            chunk = next_chunk
+        while pending:
+            fout.write(pending.popleft().result())
+        fout.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+        return size, fout.tell()
+
+
+def compress_nifti(nii_path, level=6, nb_workers=None, pool=None):
+    """Replace a .nii file by its .nii.gz (see gzip_file).
+
+    The .nii.gz is written in a temporary file then renamed, with the
+    permissions of the .nii, and the .nii is removed.
+
+    Returns (path of the .nii.gz, bytes read, bytes written).
+    """
+    gz_path = nii_path + '.gz'
+    gz_dir, gz_name = os.path.split(gz_path)
+    tmp_path = os.path.join(gz_dir, f'.{gz_name}.{uuid.uuid4().hex}.tmp')
+    try:
+        size_in, size_out = gzip_file(nii_path, tmp_path, level, nb_workers,
+                                      pool)
+        shutil.copymode(nii_path, tmp_path)
+        os.replace(tmp_path, gz_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.remove(nii_path)
+    return gz_path, size_in, size_out
+
+
+def compress_dataset(dataset_path, files=None, level=6, nb_workers=None,
+                     pool=None, manifest=None, callback=None):
+    """Compress the .nii files of a dataset in place into .nii.gz.
+
+    files are the .nii files to compress, by default all those of the
+    dataset (see load_bids_catalog). Files are compressed one after the
+    other, each one on nb_workers threads (or on pool). The import
+    manifest (manifest if given, else the one of the dataset) and the
+    checksums of the defaced images are updated, so that compressed series
+    are not imported nor defaced again.
+
+    Returns one status dict per file with keys 'file', 'output', 'status'
+    ('compressed' or 'failed'), 'seconds', 'bytes_in', 'bytes_out' and
+    'message'. callback, if given, is called with each status as soon as
+    the file is done.
+    """
+    if files is None:
+        files = [path for path
+                 in query_bids_catalog(load_bids_catalog(dataset_path))
+                 if path.endswith('.nii')]
+    if manifest is None:
+        manifest = load_import_manifest(dataset_path)
+    checksums_path = os.path.join(dataset_path, DEFACE_CHECKSUMS_FILE)
+    checksums = {}
+    if os.path.isfile(checksums_path):
+        with open(checksums_path) as fid:
+            checksums = json.load(fid)
+
+    statuses = []
+    with _worker_pool(pool, ThreadPoolExecutor,
+                      nb_workers or os.cpu_count()) as pool:
+        for nii_path in files:
+            status = {'file': nii_path, 'output': None, 'status': 'compressed',
+                      'bytes_in': 0, 'bytes_out': 0, 'message': ''}
+            start = time.time()
+            try:
+                (status['output'], status['bytes_in'],
+                 status['bytes_out']) = compress_nifti(nii_path, level,
+                                                       pool=pool)
+            except (OSError, zlib.error) as error:
+                status['status'] = 'failed'
+                status['message'] = str(error)
+            else:
+                refresh_import_manifest(dataset_path, manifest,
+                                        status['output'])
+                key = os.path.abspath(nii_path)
+                if key in checksums:
+                    del checksums[key]
+                    checksums[os.path.abspath(status['output'])] = \
+                        _file_sha1(status['output'])
+                    _write_json_atomic(checksums_path, checksums, indent=1)
+            status['seconds'] = time.time() - start
+            if callback is not None:
+                callback(status)
+            statuses.append(status)
+    return statuses
+
+
+def benchmark_compression(nii_path, levels=(1, 6, 9), nb_workers=None):
+    """Size and time of the compression of a nifti file (e.g. an EPI run)
+    for each compression level, on one thread and on nb_workers threads.
+
+    The file is compressed in a temporary directory and left untouched.
+    Returns a table with the columns level, nb_workers, seconds, mb_per_s,
+    bytes_in, bytes_out and ratio (bytes_out / bytes_in).
+    """
+    nb_workers = nb_workers or os.cpu_count()
+    results = []
+    with tempfile.TemporaryDirectory(prefix='compression_') as tmp_dir:
+        gz_path = os.path.join(tmp_dir, os.path.basename(nii_path) + '.gz')
+        for level in levels:
+            for workers in sorted({1, nb_workers}):
+                start = time.time()
+                size_in, size_out = gzip_file(nii_path, gz_path, level,
+                                              workers)
+                seconds = time.time() - start
+                results.append({'level': level, 'nb_workers': workers,
+                                'seconds': seconds,
+                                'mb_per_s': size_in / 1e6 / seconds,
+                                'bytes_in': size_in, 'bytes_out': size_out,
+                                'ratio': size_out / size_in if size_in else 1.})
+    return pd.DataFrame(results)
+
+
+def _parse_literal(text):
+    """literal_eval of a to_import cell, None if it can not be parsed"""
+    try:
+        value = literal_eval(text)
+    except (ValueError, SyntaxError, TypeError):
+        return None
+    if not isinstance(value, (list, tuple)):
+        return None
+    #Convert the first element id there is only one sequence, otherwise
+    #each value will be used as str and note tuple).
+    if value and isinstance(value[0], str):
+        value = [value]
+    return list(value)
+
+
+def _parse_json(text):
+    """json.loads of an infos_participant cell, None if it can not be
+    parsed, {} if empty"""
+    if not isinstance(text, str):
+        return {}
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def _bad_series_entry(value):
+    """Error message of a to_import entry, None if it is valid.
+
+    An entry is (series, modality, name) or (series, modality, name,
+    descriptors), series being a number or a MEG file name and modality and
+    name strings.
+    """
+    if not isinstance(value, (list, tuple)) or len(value) not in (3, 4):
+        return (f'{value!r} is not (series, modality, name) or (series, '
+                f'modality, name, descriptors)')
+    if not isinstance(value[0], (int, str)):
+        return f'series {value[0]!r} is not a number or a file name'
+    for field, text in zip(('modality', 'name'), value[1:3]):
+        if not isinstance(text, str):
+            return f'{field} {text!r} is not a string'
+    return None
+
+
+def read_import_plan(exp_info_path):
+    """Parse exp_info/participants.tsv into a table of series to import.
+
+    The table has one row per series of the to_import column, with the
+    columns participant_id, subject_id, session_id, nip, acq_date
+    (yyyymmdd), acq_label, location, db_path, series (number of the series
+    or MEG file name), modality, name, task, run, dir, tag, descriptors
+    (dict or None), target_path (folder relative to the dataset) and
+    filename. Absent optional labels are empty strings.
+
+    Also returns the participants table (without NIP) to be written in the
+    dataset: the infos_participant of every row of a participant, the first
+    value of a key winning.
+
+    The whole file is checked before anything is imported, an Exception
+    lists all the errors found.
+    """
+    pop = pd.read_csv(os.path.join(exp_info_path, 'participants.tsv'),
+                      dtype=str, sep='\t', index_col=False)
+    errors = []
+    missing = [column for column in ('NIP', 'acq_date', 'location',
+                                     'to_import') if column not in pop]
+    if missing:
+        raise Exception('exp_info/participants.tsv: missing column(s) ' +
+                        ', '.join(missing))
+    for column in ('session_label', 'acq_label', 'infos_participant'):
+        if column not in pop:
+            pop[column] = pd.Series(index=pop.index, dtype=object)
+    # line numbers of participants.tsv, for the error messages
+    lines = pd.Series(pop.index + 2, index=pop.index)
+
+    # Participants information
+    participant_ids = pop.iloc[:, 0]
+    infos = pop['infos_participant'].map(_parse_json)
+    for line in lines[infos.isnull()]:
+        errors.append(f'line {line}: infos_participant is not valid json')
+    participants = pd.DataFrame([info or {} for info in infos],
+                                index=participant_ids.values)
+    participants = participants.groupby(level=0, sort=False).first()
+
+    # One row per series
+    seqs = pop['to_import'].map(_parse_literal)
+    for line in lines[seqs.isnull()]:
+        errors.append(f'line {line}: to_import can not be parsed')
+    rows = pop.assign(seq=[seq or [] for seq in seqs]).explode('seq')
+    rows = rows[rows['seq'].notnull()]
+    bad_seq = rows['seq'].map(_bad_series_entry)
+    for line, message in zip(lines[rows.index[bad_seq.notnull()]],
+                             bad_seq[bad_seq.notnull()]):
+        errors.append(f'line {line}: {message}')
+    rows = rows[bad_seq.isnull()]
+    seq = pd.DataFrame([list(value) + [None] * (4 - len(value))
+                        for value in rows['seq']],
+                       index=rows.index).iloc[:, :4]
+    seq.columns = ['series', 'modality', 'name', 'descriptors']
+    seq['descriptors'] = seq['descriptors'].astype(object).where(
+        seq['descriptors'].notnull(), None)
+
+    subject_id = rows.iloc[:, 0].astype(str)
+    subject_id = subject_id.where(~subject_id.str.isdigit(),
+                                  'sub-' + subject_id)
+    plan = pd.DataFrame({
+        'participant_id': rows.iloc[:, 0],
+        'subject_id': subject_id,
+        'session_id': rows['session_label'].fillna(''),
+        'nip': rows['NIP'],
+        # DATE has to be transformed from BIDS to NeuroSpin server standard
+        # NeuroSpin standard is yyyymmdd -> Bids standard is YYYY-MM-DD
+        'acq_date': rows['acq_date'].str.replace('-', '').str.strip(),
+        'acq_label': rows['acq_label'].fillna(''),
+        'location': rows['location'],
+        'db_path': rows['location'].map(
+            lambda location: NEUROSPIN_DATABASES.get(location, location)),
+        'series': seq['series'].astype(str),
+        'modality': seq['modality'],
+        'name': seq['name'],
+        'descriptors': seq['descriptors'],
+    })
+    for key in ('task', 'run', 'dir'):
+        plan[key] = plan['name'].str.extract(key + '-(.+?)_',
+                                             expand=False).fillna('')
+    plan['tag'] = plan['name'].str.split('_').str[-1]
+    plan['target_path'] = [os.path.join(*parts) for parts in
+                           zip(plan['subject_id'],
+                               ('ses-' + plan['session_id']).where(
+                                   plan['session_id'] != '', ''),
+                               plan['modality'])]
+    # Expecting page 10 bids specification file name
+    # (see get_bids_file_descriptor)
+    filename = plan['subject_id']
+    for key, column in (('ses', 'session_id'), ('task', 'task'),
+                        ('acq', 'acq_label'), ('dir', 'dir'), ('run', 'run')):
+        filename = filename + ('_' + key + '-' + plan[column]).where(
+            plan[column] != '', '')
+    file_type = plan['modality'].map(lambda modality: 'fif' if modality == 'meg'
+                                     else 'nii')
+    plan['filename'] = filename + '_' + plan['tag'] + '.' + file_type
+
+    # Checks
+    line = lines[plan.index]
+    plan = plan.reset_index(drop=True)
+    line.index = plan.index
+    for i in plan.index[~subject_id.str.startswith('sub-').values]:
+        print(f'****  BIDS IMPORTATION WARMING: SUBJECT ID '
+              f'{plan.at[i, "subject_id"]} PROBABLY NOT CONFORM')
+    bad_date = ~plan['acq_date'].str.fullmatch(r'\d{8}').fillna(False)
+    for i in plan.index[bad_date]:
+        errors.append(f'line {line[i]}: acq_date {plan.at[i, "acq_date"]} '
+                      f'is not YYYY-MM-DD')
+    mri = plan['modality'].isin(['anat', 'func', 'fmap'])
+    bad_series = mri & ~plan['series'].str.fullmatch(r'\d+')
+    for i in plan.index[bad_series]:
+        errors.append(f'line {line[i]}: series {plan.at[i, "series"]} '
+                      f'is not a number')
+    bad_descriptors = plan['descriptors'].map(
+        lambda descriptors: descriptors is not None and
+        not isinstance(descriptors, dict))
+    for i in plan.index[bad_descriptors]:
+        errors.append(f'line {line[i]}: the 4th element of a series must '
+                      f'be a dict')
+    target = plan['target_path'] + os.sep + plan['filename']
+    for i in plan.index[target.duplicated()]:
+        errors.append(f'line {line[i]}: {target[i]} is imported twice')
+    for i in plan.index[~mri & (plan['modality'] != 'meg')]:
+        print(f'****  BIDS IMPORTATION WARMING: UNKNOWN MODALITY '
+              f'{plan.at[i, "modality"]} IGNORED (line {line[i]})')
+    if errors:
+        raise Exception('exp_info/participants.tsv:\n' + '\n'.join(errors))
+    return plan, participants
+
+
+def index_acquisition_date(db_path, acq_date, ttl=ACQUISITION_INDEX_TTL):
+    """Index of the acquisitions of one day in a NeuroSpin database.
+
+    Returns {NIP directory name: {series number: [series directory names]}}
+    for db_path/acq_date, series numbers being the 6 digits prefix of the
+    series directories ('000024' for '000024_t1_mprage'). The day is read
+    with one os.scandir per directory, then the index is kept in memory
+    for ttl seconds, or until the mtime of the date directory or of one of
+    its NIP directories changes (a series added to a NIP directory does
+    not change the date directory).
+
+    db_path can be any directory organised as the NeuroSpin databases,
+    e.g. a local fake tree <db_path>/<yyyymmdd>/<nip_dir>/<nnnnnn>_<name>.
+    """
+    date_path = os.path.join(db_path, acq_date)
+    try:
+        mtime = os.stat(date_path).st_mtime
+    except OSError:
+        return {}
+    now = time.time()
+    cached = _acquisition_index.get(date_path)
+    if cached is not None and now - cached[0] < ttl and cached[1] == mtime:
+        nip_mtimes = {}
+        for nip_dir in cached[2]:
+            try:
+                nip_mtimes[nip_dir] = os.stat(
+                    os.path.join(date_path, nip_dir)).st_mtime
+            except OSError:
+                break
+        if nip_mtimes == cached[2]:
+            return cached[3]
+    index = {}
+    nip_mtimes = {}
+    with os.scandir(date_path) as nip_entries:
+        for nip_entry in nip_entries:
+            if nip_entry.name.startswith('.') or not nip_entry.is_dir():
+                continue
+            nip_mtimes[nip_entry.name] = nip_entry.stat().st_mtime
+            series = index[nip_entry.name] = {}
+            with os.scandir(nip_entry.path) as series_entries:
+                for series_entry in series_entries:
+                    number, sep, _ = series_entry.name.partition('_')
+                    if sep and number.isdigit() and len(number) >= 6:
+                        series.setdefault(number, []).append(series_entry.name)
+            for names in series.values():
+                names.sort()
+    _acquisition_index[date_path] = (now, mtime, nip_mtimes, index)
+    return index
+
+
+def clear_acquisition_index():
+    """Forget the cached indexes of the acquisition databases"""
+    _acquisition_index.clear()
+    _meg_subject_info.clear()
+
+
+def find_series_dirs(db_path, acq_date, nip, series):
+    """NIP directories of a day and the directories of one of their series.
+
+    Equivalent to globbing db_path/acq_date/nip* and then
+    <nip_dir>/<series:06d>_* in the only NIP directory found, but served by
+    index_acquisition_date. Returns (nip_dirs, series_dirs), series_dirs
+    being empty unless there is exactly one NIP directory.
+    """
+    index = index_acquisition_date(db_path, acq_date)
+    nip_dirs = sorted(nip_dir for nip_dir in index if nip_dir.startswith(nip))
+    series_dirs = []
+    if len(nip_dirs) == 1:
+        series_dirs = [os.path.join(db_path, acq_date, nip_dirs[0], name)
+                       for name in index[nip_dirs[0]].get(
+                           '{0:06d}'.format(int(series)), [])]
+    return ([os.path.join(db_path, acq_date, nip_dir)
+             for nip_dir in nip_dirs], series_dirs)
+
+
+def plan_import(data_root_path='', dataset_name=None, force_download=False,
+                hash_series=False):
+    """Import plan of exp_info/participants.tsv, without writing anything.
+
+    Returns the tables of read_import_plan, the series table having the
+    extra columns:
+    source: the DICOM series directory or the MEG file
+    source_fingerprint: see dicom_series_fingerprint
+    status: 'convert', 'imported' (up to date in the dataset manifest),
+    'unrecorded' (imported before the manifest existed), 'not_found',
+    'no_nip_dir', 'multiple_nip_dirs' or 'ignored' (unknown modality)
+    message: warning explaining a status
+
+    The NeuroSpin server and the dataset are only read, so that plans can
+    be computed and compared (see export_import_plan) at any time.
+    """
+    exp_info_path = os.path.join(data_root_path, 'exp_info')
+    if not os.path.exists(exp_info_path):
+        raise Exception('exp_info directory not found')
+    if not os.path.isfile(os.path.join(exp_info_path, 'participants.tsv')):
+        raise Exception('exp_info/participants.tsv not found')
+    dataset_name, target_root_path = get_bids_default_path(data_root_path,
+                                                           dataset_name)
+    plan, participants = read_import_plan(exp_info_path)
+    manifest = load_import_manifest(target_root_path)
+
+    resolved = []
+    for value in plan.itertuples(index=False):
+        source, fingerprint, status, message = None, None, 'ignored', ''
+        session_id = value.session_id or None
+        # MEG CASE
+        if value.modality == 'meg':
+            source = os.path.join(value.db_path, value.nip, value.acq_date,
+                                  value.series)
+            if os.path.isfile(source):
+                status = 'convert'
+            else:
+                status = 'not_found'
+                message = "\n WARNING: file not found " + source
+        # ANAT and FUNC case
+        elif value.modality in ('anat', 'func', 'fmap'):
+            with _acquisition_server():
+                nip_dirs, dicom_paths = find_series_dirs(value.db_path,
+                                                         value.acq_date,
+                                                         value.nip,
+                                                         value.series)
+            if len(nip_dirs) < 1:
+                status = 'no_nip_dir'
+                message = (f"\n WARNING: No directory found for given NIP "
+                           f"{value.nip} and SESSION {session_id}")
+            elif len(nip_dirs) > 1:
+                status = 'multiple_nip_dirs'
+                message = (f"\n  WARNING: Multiple path for given NIP "
+                           f"{value.nip} SESSION {session_id} - please "
+                           f"mention the session of the subject for this "
+                           f"date, 2 sessions for the same subject the same "
+                           f"day are possible")
+            else:
+                path_file_glob = os.path.join(nip_dirs[0], '{0:06d}_*'.
+                                              format(int(value.series)))
+                if not dicom_paths:
+                    status = 'not_found'
+                    message = "\n WARNING: file not found " + path_file_glob
+                else:
+                    source = dicom_paths[0]
+                    with _acquisition_server():
+                        fingerprint = dicom_series_fingerprint(source,
+                                                               hash_series)
+                    series = os.path.join(value.target_path,
+                                          _output_stem(value.filename))
+                    if force_download:
+                        status = 'convert'
+                    elif series in manifest:
+                        status = ('imported' if is_series_imported(
+                            target_root_path, manifest, series, fingerprint)
+                                  else 'convert')
+                    elif os.path.isfile(_nifti_path(
+                            os.path.join(target_root_path, value.target_path,
+                                         value.filename))):
+                        status = 'unrecorded'
+                    else:
+                        status = 'convert'
+        resolved.append((source, fingerprint, status, message))
+    resolved = pd.DataFrame(resolved, index=plan.index,
+                            columns=['source', 'source_fingerprint',
+                                     'status', 'message'])
+    return pd.concat([plan, resolved], axis=1), participants
+
+
+def export_import_plan(plan, plan_path):
+    """Save an import plan as json (.json extension) or tsv.
+
+    Rows and keys are written in a stable order so that plans of
+    successive runs can be compared with diff.
+    """
+    plan = plan.astype(object).where(plan.notnull(), None)
+    records = plan.to_dict(orient='records')
+    plan_dir = os.path.dirname(plan_path)
+    if plan_dir and not os.path.exists(plan_dir):
+        os.makedirs(plan_dir)
+    if plan_path.endswith('.json'):
+        with open(plan_path, 'w') as fid:
+            json.dump(records, fid, indent=1, sort_keys=True)
+    else:
+        table = plan.copy()
+        for column in ('descriptors', 'source_fingerprint'):
+            table[column] = [None if value is None else
+                             json.dumps(value, sort_keys=True)
+                             for value in table[column]]
+        table.to_csv(plan_path, sep='\t', index=False)
+
+
+def _print_import_summary(list_already_imported, list_imported, list_warning):
+    print("\n------------------------------------------------------------------------------------")
+    print("-------------------    SUMMARY OF IMPORTATION   --------------------------------------")
+    print("--------------------------------------------------------------------------------------\n")
+    for items in (list_already_imported, list_imported, list_warning):
+        for i in items:
+            print(i)
+        print("\n------------------------------------------------------------------------------------")
+    print("------------------------------------------------------------------------------------\n")
+
+
+def _files_size(paths):
+    """Total size of the existing files of paths"""
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def open_import_log(log_path):
+    """Open a JSON Lines import log for appending.
+
+    The file is line buffered: every event is on disk as soon as it is
+    logged, and a long importation can be followed with tail -f.
+    """
+    return open(log_path, 'a', buffering=1)
+
+
+def log_import_event(log, stage, status, seconds=0., bytes_in=0, bytes_out=0,
+                     **fields):
+    """Append one event to an import log (see open_import_log).
+
+    stage is 'plan', 'convert', 'meg', 'deface', 'sidecar', 'events' or
+    'validate', status the status of the series or file for this stage, or
+    'total' for the wall time of the whole stage. mb_per_s is the larger
+    of bytes_in and bytes_out per second of wall time. Other fields
+    (source, target, message ...) are written as is.
+
+    Returns the event dict.
+    """
+    event = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+             'stage': stage,
+             'status': status,
+             'seconds': round(seconds, 3),
+             'bytes_in': bytes_in,
+             'bytes_out': bytes_out,
+             'mb_per_s': (round(max(bytes_in, bytes_out) / 1e6 / seconds, 3)
+                          if seconds > 0 else None)}
+    event.update(fields)
+    log.write(json.dumps(event) + '\n')
+    return event
+
+
+def summarize_import_log(log_path):
+    """Summary of an import log per stage and status.
+
+    Returns a table indexed by (stage, status) with the number of events,
+    the total seconds, bytes_in and bytes_out, and mb_per_s. The seconds
+    of series processed in parallel add up: the 'total' rows give the
+    wall time of each stage. Lines cut by a crash are ignored.
+    """
+    events = []
+    with open(log_path) as fid:
+        for line in fid:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    columns = ['nb_events', 'seconds', 'bytes_in', 'bytes_out']
+    if not events:
+        return pd.DataFrame(columns=columns + ['mb_per_s'],
+                            index=pd.MultiIndex.from_arrays(
+                                [[], []], names=['stage', 'status']))
+    events = pd.DataFrame(events)
+    summary = events.groupby(['stage', 'status'], sort=False).agg(
+        nb_events=('stage', 'size'), seconds=('seconds', 'sum'),
+        bytes_in=('bytes_in', 'sum'), bytes_out=('bytes_out', 'sum'))
+    seconds = summary['seconds'].where(summary['seconds'] > 0)
+    summary['mb_per_s'] = (summary[['bytes_in', 'bytes_out']].max(axis=1)
+                           / 1e6 / seconds).round(3)
+    return summary
+
+
+def _update_json_sidecar(json_path, descriptors):
+    """Add all descriptors to a json file, written once atomically"""
+    with open(json_path) as fid:
+        sidecar = json.load(fid)
+    sidecar.update(descriptors)
+    _write_json_atomic(json_path, sidecar)
+
+
+def update_json_sidecars(dict_descriptors, nb_workers=None, callback=None,
+                         pool=None):
+    """Add descriptors such as TaskName or IntendedFor to json sidecars.
+
+    dict_descriptors is {json path: {key: value}}. Every file is read once,
+    updated with all its keys and replaced atomically (temporary file and
+    rename), files being processed on a thread pool of nb_workers, or on
+    pool if given.
+
+    Returns one status dict per file with keys 'file', 'status' ('updated'
+    or 'failed') and 'message'. callback, if given, is called with each
+    status as soon as the file is done.
+    """
+    statuses = []
+    if not dict_descriptors:
+        return statuses
+    with _worker_pool(pool, ThreadPoolExecutor,
+                      nb_workers or os.cpu_count()) as pool:
+        jobs = {pool.submit(_update_json_sidecar, json_path, descriptors):
+                json_path for json_path, descriptors in dict_descriptors.items()}
+        for job in as_completed(jobs):
+            status = {'file': jobs[job], 'status': 'updated', 'message': ''}
+            try:
+                job.result()
+            except (OSError, ValueError) as error:
+                status['status'] = 'failed'
+                status['message'] = str(error)
+            if callback is not None:
+                callback(status)
+            statuses.append(status)
+    return statuses
+
+
+def _is_bids_chunk(paths):
+    """BIDSValidator.is_bids of a list of dataset paths"""
+    validator = BIDSValidator()
+    return [validator.is_bids(path) for path in paths]
+
+
+def bids_validate_files(dataset_path, cache_path=None, nb_workers=None,
+                        chunk_size=1000, pool=None):
+    """Check the names of the files of a dataset with BIDSValidator.
+
+    Files are listed with the dataset catalog (see load_bids_catalog) and
+    only files new or changed since the last validation are checked, the
+    results of the others being read from cache_path (by default
+    dataset_path/.bids_validation.json). Files are checked by chunks on a
+    process pool of nb_workers, or on pool if given. The working directory
+    is never changed.
+
+    Returns a summary dict with the number of files, of files checked and
+    of valid files, and the sorted list of invalid files.
+    The worker processes import __main__ again: call it under
+    if __name__ == '__main__' (see _process_pool).
+    """
+    if cache_path is None:
+        cache_path = os.path.join(dataset_path, BIDS_VALIDATION_CACHE_FILE)
+    cache = {}
+    if os.path.isfile(cache_path):
+        with open(cache_path) as fid:
+            cache = json.load(fid)
+
+    catalog = load_bids_catalog(dataset_path)
+    files = {}
+    for rel_dir, entry in catalog['dirs'].items():
+        for file_name, (size, mtime) in entry['files'].items():
+            # BIDSValidator expects paths relative to the dataset root
+            path = '/' + Path(rel_dir, file_name).as_posix()
+            files[path] = [size, mtime]
+    results = {path: cache[path] for path, stat in files.items()
+               if path in cache and cache[path][:2] == stat}
+    to_check = sorted(set(files) - set(results))
+    chunks = [to_check[i:i + chunk_size]
+              for i in range(0, len(to_check), chunk_size)]
+    if len(chunks) > 1:
+        with _worker_pool(pool, _process_pool, nb_workers) as pool:
+            checked = [valid for chunk in pool.map(_is_bids_chunk, chunks)
+                       for valid in chunk]
+    else:
+        checked = [valid for chunk in chunks for valid in _is_bids_chunk(chunk)]
+    for path, valid in zip(to_check, checked):
+        results[path] = files[path] + [bool(valid)]
+    if results != cache:
+        _write_json_atomic(cache_path, results)
+
+    invalid = sorted(path for path, result in results.items() if not result[2])
+    return {'dataset': dataset_path,
+            'nb_files': len(results),
+            'nb_checked': len(to_check),
+            'nb_valid': len(results) - len(invalid),
+            'invalid': invalid}
+
+
+def meg_subject_info(meg_dir, ttl=ACQUISITION_INDEX_TTL):
+    """Information shared by the MEG runs of a subject acquisition day.
+
+    meg_dir is the <db_path>/<nip>/<acq_date> directory of the runs.
+    Returns a dict with 'empty_room', the path of the empty room recording
+    of the day ('empty' in its name) or None. Only the directory is listed;
+    the information is kept in memory for ttl seconds, or until the mtime
+    of the directory changes.
+    """
+    try:
+        mtime = os.stat(meg_dir).st_mtime
+    except OSError:
+        return {'empty_room': None}
+    now = time.time()
+    cached = _meg_subject_info.get(meg_dir)
+    if cached is not None and now - cached[0] < ttl and cached[1] == mtime:
+        return cached[2]
+    empty_rooms = sorted(run for run in glob.glob(os.path.join(meg_dir,
+                                                               '*.fif'))
+                         if 'empty' in os.path.basename(run).lower())
+    info = {'empty_room': empty_rooms[0] if empty_rooms else None}
+    _meg_subject_info[meg_dir] = (now, mtime, info)
+    return info
+
+
+def _convert_meg_run(meg_run):
+    """Write one MEG run in the dataset with mne_bids.
+
+    If the empty room recording of the run is imported too, its path in
+    the dataset is written as AssociatedEmptyRoom in the run sidecar.
+    Returns the seconds spent in the worker, without the time waiting in
+    the pool.
+    """
+    start = time.time()
+    raw = mne.io.read_raw_fif(meg_run['source'], allow_maxshield=True,
+                              verbose=False)
+    write_raw_bids(raw, meg_run['filename'], meg_run['target_path'],
+                   overwrite=True)
+    sidecar = os.path.join(meg_run['target_path'],
+                           os.path.splitext(meg_run['filename'])[0] + '.json')
+    if meg_run.get('empty_room_target') and os.path.isfile(sidecar):
+        _update_json_sidecar(sidecar, {'AssociatedEmptyRoom':
+                                       meg_run['empty_room_target']})
+    return time.time() - start
+
+
+def convert_meg_runs(meg_runs, nb_workers=None, callback=None, pool=None,
+                     dataset_path=None):
+    """Convert MEG runs to bids on a process pool, one run per worker.
+
+    meg_runs are dicts with 'source' (fif file), 'target_path' and
+    'filename' keys. The subject information of meg_subject_info is
+    computed once per acquisition day and added to every run, with
+    'empty_room_target', the path relative to dataset_path of the empty
+    room recording when it is one of meg_runs (None otherwise). pool, if
+    given, is a process pool shared with other importations.
+
+    Returns one status dict per run, with the keys of the run plus
+    'status' ('converted' or 'failed'), 'seconds' (spent converting in the
+    worker, 0 if it failed) and 'message'. callback, if given, is called
+    with each status as soon as the run is done.
+    The worker processes import __main__ again: call it under
+    if __name__ == '__main__' (see _process_pool).
+    """
+    statuses = []
+    if not meg_runs:
+        return statuses
+    targets = {meg_run['source']: os.path.join(meg_run['target_path'],
+                                               meg_run['filename'])
+               for meg_run in meg_runs}
+    slots = _acquisition_server_slots
+    with _worker_pool(pool, _process_pool,
+                      nb_workers or os.cpu_count()) as pool:
+        jobs = {}
+        for meg_run in meg_runs:
+            with _acquisition_server():
+                meg_run = dict(meg_run, **meg_subject_info(
+                    os.path.dirname(meg_run['source'])))
+            empty_room = meg_run['empty_room']
+            meg_run['empty_room_target'] = None
+            if (dataset_path is not None and empty_room in targets and
+                    empty_room != meg_run['source']):
+                meg_run['empty_room_target'] = os.path.relpath(
+                    targets[empty_room], dataset_path)
+            # The run is read in another process: its slot of the
+            # acquisition server is released when the run is done
+            if slots is not None:
+                slots.acquire()
+            job = pool.submit(_convert_meg_run, meg_run)
+            if slots is not None:
+                job.add_done_callback(lambda job: slots.release())
+            jobs[job] = meg_run
+        for job in as_completed(jobs):
+            status = dict(jobs[job], status='converted', seconds=0.,
+                          message='')
+            try:
+                status['seconds'] = job.result()
+            except Exception as error:
+                status['status'] = 'failed'
+                status['message'] = str(error)
+            if callback is not None:
+                callback(status)
+            statuses.append(status)
+    return statuses
 
 
 def bids_acquisition_download(data_root_path='', dataset_name=None,
@@ -310,7 +1827,18 @@ def bids_acquisition_download(data_root_path='', dataset_name=None,
                               behav_path='exp_info/recorded_events',
                               copy_events='n',
                               deface=False,
-                              dry_run=False):
+                              dry_run=False,
+                              converter='dcm2niix',
+                              nb_workers=None,
+                              conversion_timeout=None,
+                              conversion_retries=0,
+                              hash_series=False,
+                              plan_output=None,
+                              events_mode='copy',
+                              config=None,
+                              thread_pool=None,
+                              process_pool=None,
+                              compress_level=None):
     """Automatically download files from neurospin server to a BIDS dataset.
 
     Download-database is based on NeuroSpin server conventions.
@@ -336,45 +1864,100 @@ def bids_acquisition_download(data_root_path='', dataset_name=None,
     5) There is more than one acquisition directory (Have to ask manip for
     extra digits for NIP, the NIP then would look like xxxxxxxx-ssss)
     6) Event file corresponding to downloaded bold.nii not found
+
+    DICOM series are converted by one dcm2niix process per series, at most
+    nb_workers at a time (see dcm2nii_convert). With converter='dcm2niibatch'
+    or when dcm2niix is not installed, the whole batch_dcm2nii.yaml file is
+    converted by a single dcm2niibatch call instead.
+
+    Imported series are recorded in the dataset manifest (see
+    load_import_manifest) with a fingerprint of their DICOM files and of
+    their outputs: unless force_download, a series is converted again only
+    if it is new, its DICOM files changed or its outputs were modified.
+    With hash_series the DICOM fingerprint includes a hash of their content.
+
+    The import plan (see plan_import) is returned, and saved in plan_output
+    if given (see export_import_plan). With dry_run, nothing else is
+    written: neither the dataset nor the report are created.
+
+    With a config (see load_import_config), the importation does not ask
+    anything, for unattended runs.
+
+    With a compress_level (1 fast to 9 small), the converted .nii files are
+    compressed into .nii.gz after defacing (see compress_dataset).
+
+    thread_pool and process_pool, if given, run the conversions, sidecar
+    updates and copies (threads), and the MEG conversions, defacing and
+    validation (processes) instead of pools of nb_workers, so that several
+    importations share them (see bids_batch_download).
+    The worker processes import __main__ again: call it under
+    if __name__ == '__main__' (see _process_pool).
     """
 
-    ### CHECK PATHS AND FILES
-    
-    # exp_info path where is the participants.tsv
-    # print(data_root_path)
+    ### GETTING FOR INFORMATION TO DOWNLOAD
+
+    # Download command for each subject/session
+    # one line has the following information
+    # participant_id / NIP / infos_participant / session_label / acq_date / location / to_import
+    start = time.time()
+    plan, df_participant = plan_import(data_root_path, dataset_name,
+                                       force_download=force_download,
+                                       hash_series=hash_series)
+    plan_seconds = time.time() - start
+    if plan_output is not None:
+        export_import_plan(plan, plan_output)
+
+    if dry_run:
+        found = plan['source'].notnull()
+        _print_import_summary(
+            [f" ALREADY IMPORTED: {path}" for path in plan['filename'][
+                plan['status'].isin(['imported', 'unrecorded'])]],
+            ["\n IMPORTATION OF " + path for path in plan['source'][found]],
+            list(plan['message'][plan['message'] != '']))
+        print("\n NO IMPORTATION, DRY-RUN OPTION IS TRUE \n")
+        return plan
+
     exp_info_path = os.path.join(data_root_path, 'exp_info')
-    if not os.path.exists(exp_info_path):
-        raise Exception('exp_info directory not found')
-    if not os.path.isfile(os.path.join(exp_info_path, 'participants.tsv')):
-        raise Exception('exp_info/participants.tsv not found')
 
     # Determine target path with the name of dataset 
     dataset_name, target_root_path = get_bids_default_path(data_root_path, dataset_name)
 
     # Create dataset directories and files if necessary
-    bids_init_dataset(data_root_path, dataset_name)
+    bids_init_dataset(data_root_path, dataset_name, config=config)
 
-    # Manage the report and download information
-    download_report = ('download_report_' + time.strftime("%d-%b-%Y-%H:%M:%S", 
-                        time.gmtime()) + '.csv')
+    # Series already imported
+    manifest = load_import_manifest(target_root_path)
+
+    # Manage the report and download information: one JSON line per event
     report_path = os.path.join(data_root_path, 'report')
     if not os.path.exists(report_path):
         os.makedirs(report_path)
-    download_report = open(os.path.join(report_path, download_report), 'w')
-    #report_line = '%s,%s,%s\n' % ('subject_id', 'session_id', 'download_file')
-    #download_report.write(report_line)
+    # The suffix keeps apart the reports of runs started in the same second
+    download_report_path = os.path.join(
+        report_path, 'download_report_' + time.strftime("%d-%b-%Y-%H:%M:%S",
+                                                        time.gmtime())
+        + '_' + uuid.uuid4().hex[:8] + '.jsonl')
+    download_report = open_import_log(download_report_path)
+    for value in plan.itertuples(index=False):
+        log_import_event(download_report, 'plan', value.status,
+                         bytes_in=(value.source_fingerprint['size']
+                                   if isinstance(value.source_fingerprint, dict)
+                                   else 0),
+                         source=(value.source if isinstance(value.source, str)
+                                 else None),
+                         target=os.path.join(value.target_path, value.filename),
+                         message=value.message.strip())
+    log_import_event(download_report, 'plan', 'total', seconds=plan_seconds,
+                     nb_series=len(plan))
     list_imported = []
     list_already_imported = []
     list_warning = []
     
-    # Create a dataFrame to store participant information
-    #df_participant = pd.DataFrame()    
-    #Dict for info participant
-    #list_all_participants = {}
-    dic_info_participants = OrderedDict()
-    
     # List for the bacth file for dc2nii_batch command
     infiles_dcm2nii = []
+
+    # Series to convert: (out_dir, filename) -> (dicom_path, fingerprint)
+    series_to_record = {}
     
     # List for data to deface
     files_for_pydeface = []
@@ -382,357 +1965,460 @@ def bids_acquisition_download(data_root_path='', dataset_name=None,
     #Dict of descriptors to be added
     dict_descriptors = {}
 
-    ### GETTING FOR INFORMATION TO DOWNLOAD
-    
-    # Download command for each subject/session
-    # one line has the following information
-    # participant_id / NIP / infos_participant / session_label / acq_date / location / to_import
-
-    # Read the participants.tsv file for getting subjects/sessions to download
-    pop = pd.read_csv(os.path.join(exp_info_path, 'participants.tsv'),
-                      dtype=str, sep='\t', index_col=False)
-    
-    #print(df_participant)
-
-    for row_idx, subject_info in pop.iterrows():
-        # Fill the partcipant information for the participants.tsv
-        if subject_info[0] in dic_info_participants:
-            existing_items = dic_info_participants[subject_info[0]]
-            dico_add = {}
-            info_participant = json.loads(subject_info['infos_participant'])
-            for k,v in info_participant.items():
-                if not k in existing_items :
-                    dico_add[k] = v
-            #fusion dicos  
-            existing_items.update(dico_add)
-            dic_info_participants[subject_info[0]] = existing_items
-        else :
-            dic_info_participants[subject_info[0]] = json.loads(subject_info['infos_participant'])
-
-        # Determine path to files in NeuroSpin server  
-        download_database = subject_info['location']        
-        if download_database in NEUROSPIN_DATABASES:
-            db_path = NEUROSPIN_DATABASES[download_database]
-        else:
-            db_path = download_database         
-        
-        # the row_idx for giving either participant_label or participant_id
-        subject_id = subject_info[0]
-         
-        # sub_path = target_root_path + subject_id + ses_path
-        # Mange the optional filters
-        # optional_filters = [('sub', subject_id)]
-        # if session_id is not None:
-        #  optional_filters += [('ses', session_id)]
-        if 'session_label' in subject_info.index:
-            if subject_info['session_label'] is not pd.np.nan:
-                session_id = subject_info['session_label']
-            else:
-                session_id = None
-        if session_id is None:
-            ses_path = ''
-        else:
-            ses_path = 'ses-' + session_id     
-        try:
-            int(subject_id)
-            subject_id = 'sub-{0}'.format(subject_id)
-        except:
-            if ('sub-') in subject_id:
-                subject_id = subject_id
-            else:
-                subject_id = subject_id
-                print('****  BIDS IMPORTATION WARMING: SUBJECT ID PROBABLY '
-                      'NOT CONFORM')
-        sub_path = os.path.join(target_root_path, subject_id, ses_path)
-        if not os.path.exists(sub_path):
-            os.makedirs(sub_path)
+    # List of MEG runs to convert
+    meg_runs = []
+
+    # download data, store information in batch files for anat/fmri
+    # download data for meg data
+    for value in plan.itertuples(index=False):
+        if value.message:
+            list_warning.append(value.message)
+        if not isinstance(value.source, str):
+            continue
+        filename = value.filename
+        target_path = os.path.join(target_root_path, value.target_path)
+        if not os.path.exists(target_path):
+                os.makedirs(target_path)
             
-        # Avoid redownloading subjects/sessions
-        if not force_download:
-            check_file = os.path.join(sub_path, 'downloaded')
-            if os.path.isfile(check_file):
-                continue
-
-
-        # DATE has to be transformed from BIDS to NeuroSpin server standard
-        # NeuroSpin standard is yyyymmdd -> Bids standard is YYYY-MM-DD
-        acq_date = subject_info['acq_date'].replace('-', '').replace('\n', '')
-        
-        #acq_label
-        acq_label = subject_info['acq_label']
-
-        #dir_label
-        #dir_label = subject_info['dir_label']
-        
-        # nip number
-        nip = subject_info['NIP']
-
-
-        # Get appropriate download file. As specific as possible
-        # specs_path = file_manager_default_file(exp_info_path,
-        #                                optional_filters, 'download',
-        #                               file_type='tsv',
-        #                               allow_other_fields=False)
-        #report_line = '%s,%s,%s\n' % (subject_id, session_id, specs_path)
-        #download_report.write(report_line)
-
-        #specs = pd.read_csv(specs_path, dtype=str, sep='\t', index_col=False)
-        
-        
-        # Retrieve list of list for seqs to import
-        # One tuple is configured as :(file_to_import;acq_folder;acq_name) 
-        # value[0] : num of seq
-        # value[1] : modality
-        # value[2] : part of ht file_name
-        print("Scans for ", subject_info['NIP'])
-        print(subject_info['to_import'])
-        seqs_to_retrieve = literal_eval(subject_info['to_import'])
-        #Convert the first element id there is only one sequence, otherwise
-        #each value will be used as str and note tuple).
-        if isinstance(seqs_to_retrieve[0], str) :
-            seqs_to_retrieve = [seqs_to_retrieve]
-
-        # download data, store information in batch files for anat/fmri
-        # download data for meg data
-        for value in seqs_to_retrieve:
-            #print(seqs_to_retrieve)
-            def get_value(key, text):
-                m = re.search(key + '-(.+?)_', text)
-                if m:
-                    return m.group(1)
-                else:
-                    return None
-
-            run_task = get_value('task', value[2])
-            run_id = get_value('run', value[2])  
-            run_dir = get_value('dir', value[2])
-            run_session = session_id
-            
-            
-            tag = value[2].split('_')[-1]
-
-            target_path = os.path.join(sub_path, value[1])
-            if not os.path.exists(target_path):
-                    os.makedirs(target_path)
+        # MEG CASE
+        if value.modality == 'meg':
+            # Create the sub-emptyroom
+            #sub-emptyroom_path = os.path.join(data_root_path, 'sub_emptyroom')
+            #if not os.path.exists(sub-emptyroom_path):
+            #    os.makedirs(sub-emptyroom_path)
             
+            meg_runs.append({'source': value.source,
+                             'target_path': target_path,
+                             'filename': filename})
+            # add event 
+            # create json file
+            #copy the subject emptyroom
             
-            # MEG CASE
-            if value[1] == 'meg':
-                # Create subject path if necessary
-                meg_path = os.path.join(sub_path, 'meg')
-                if not os.path.exists(meg_path):
-                    os.makedirs(meg_path)
-                    
-                # Create the sub-emptyroom
-                #sub-emptyroom_path = os.path.join(data_root_path, 'sub_emptyroom')
-                #if not os.path.exists(sub-emptyroom_path):
-                #    os.makedirs(sub-emptyroom_path)
-                
-                meg_file = os.path.join(db_path, nip, acq_date, value[0])
-                print(meg_file)
-                filename = get_bids_file_descriptor(subject_id, 
-                                                    task_id=run_task,
-                                                    run_id=run_id,
-                                                    run_dir=run_dir,
-                                                    session_id=run_session,
-                                                    file_tag=tag,
-                                                    acq_label=acq_label,
-                                                    file_type='tif')
-                #output_path = os.path.join(target_path, filename)
-                #print(output_path)
-                #shutil.copyfile(meg_file, output_path)
-                raw = mne.io.read_raw_fif(meg_file, allow_maxshield=True)
-
-                write_raw_bids(raw, filename, target_path,
-                                overwrite=True)
-                # add event 
-                # create json file
-                #copy the subject emptyroom
+        # ANAT and FUNC case    
+        else:
+            dicom_path = value.source
+            list_imported.append("\n IMPORTATION OF " + dicom_path)
+                           
+            if value.modality == 'anat' and deface :
+                files_for_pydeface.append(os.path.join(target_path, filename))
+
+            # append list for preparing the batch importation
+            file_to_convert = {'in_dir': dicom_path, 
+                               'out_dir': target_path, 
+                               'filename': os.path.splitext(filename)[0]}
+            is_file_to_import = _nifti_path(os.path.join(os.getcwd(), target_path, filename))
+            series = os.path.join(value.target_path, file_to_convert['filename'])
+            if value.status == 'unrecorded':
+                # Imported before the manifest existed
+                record_import_manifest(target_root_path, manifest, series,
+                                       dicom_path, value.source_fingerprint)
+            if value.status in ('imported', 'unrecorded'):
+                list_already_imported.append(f" ALREADY IMPORTED: {is_file_to_import}")
+            else :
+                infiles_dcm2nii.append(file_to_convert)
+                series_to_record[(target_path, file_to_convert['filename'])] = (
+                    dicom_path, value.source_fingerprint)
                 
-            # ANAT and FUNC case    
-            elif (value[1] == 'anat') or (value[1] == 'func') or (value[1] == 'fmap'):
-                download = True
-                dicom_paths = []
-                path_file_glob = ""
-                nip_dirs = glob.glob(os.path.join(db_path, str(acq_date), str(nip) + '*'))
-                #print(os.path.join(db_path, str(acq_date), str(nip) + '*'))
-                if len(nip_dirs) < 1:
-                    list_warning.append(f"\n WARNING: No directory found for given NIP {nip} and SESSION {session_id}")
-                    #print(message)
-                    #download_report.write(message) 
-                    download = False
-                elif len(nip_dirs) > 1:
-                    list_warning.append(f"\n  WARNING: Multiple path for given NIP {nip} \
-                            SESSION {session_id} - please \
-                            mention the session of the subject for this date, \
-                            2 sessions for the same subject the same day are \
-                            possible")
-                    #print(message)
-                    #download_report.write(message) 
-                    download = False
-                else:
-                    path_file_glob = os.path.join(nip_dirs[0], '{0:06d}_*'.
-                                                  format(int(value[0])))
-                    #print(path_file_glob)
-                    dicom_paths = glob.glob(path_file_glob)
-                    
-                if not dicom_paths and download:
-                    list_warning.append("\n WARNING: file not found " + path_file_glob)
-                    #print(message)
-                    #download_report.write(message) 
-                elif download:
-                    dicom_path = dicom_paths[0]
-                    list_imported.append("\n IMPORTATION OF " + dicom_path)
-                    #print(message)
-                    #download_report.write(message)
-                    # Expecting page 10 bids specification file name
-                    filename = get_bids_file_descriptor(subject_id, 
-                                                        task_id=run_task,
-                                                        run_id=run_id,
-                                                        run_dir=run_dir,
-                                                        session_id=run_session,
-                                                        file_tag=tag,
-                                                        acq_label=acq_label,
-                                                        file_type='nii')
-                                   
-                    if value[1] == 'anat' and deface :
-                        print("\n Deface with pydeface")
-                        files_for_pydeface.append(os.path.join(target_path, filename))
-    
-                    # append list for preparing the batch importation
-                    file_to_convert = {'in_dir': dicom_path, 
-                                       'out_dir': target_path, 
-                                       'filename': os.path.splitext(filename)[0]}
-                    is_file_to_import = os.path.join(os.path.join(os.getcwd(), target_path, filename))
-                    
-                    if (os.path.isfile( is_file_to_import )):
-                        list_already_imported.append(f" ALREADY IMPORTED: {is_file_to_import}")
-                    else :
-                        infiles_dcm2nii.append(file_to_convert)
-                        
-                    # Add descriptor into the json file
-                    if run_task:
-                        filename_json = os.path.join(target_path, filename[:-3] + 'json')
-                        dict_descriptors.update({filename_json: {'TaskName':run_task}})
-                    
-                    
-                    if len(value)==4 :
-                        #print('value[3]', value[3] )
-                        filename_json = os.path.join(target_path, filename[:-3] + 'json')
-                        dict_descriptors.update({filename_json: value[3] })                   
+            # Add descriptor into the json file
+            filename_json = _output_stem(os.path.join(target_path, filename)) + '.json'
+            if value.task:
+                dict_descriptors.setdefault(filename_json, {})['TaskName'] = value.task
+            if isinstance(value.descriptors, dict) :
+                dict_descriptors.setdefault(filename_json, {}).update(value.descriptors)
                 
-        #Importation and conversion of dicom files        
-        dcm2nii_batch = dict(Options=dict(isGz='false', 
-                                          isFlipY='false', 
-                                          isVerbose='false', 
-                                          isCreateBIDS='true',
-                                          isOnlySingleFile='false'), 
-                                          Files=infiles_dcm2nii)
+    #Importation and conversion of dicom files
+    dcm2nii_batch = dict(Options=DCM2NII_OPTIONS, Files=infiles_dcm2nii)
 
     dcm2nii_batch_file = os.path.join(exp_info_path, 'batch_dcm2nii.yaml')
     with open(dcm2nii_batch_file, 'w') as f:
         data = yaml.dump(dcm2nii_batch, f)
   
-    print("\n------------------------------------------------------------------------------------")
-    print("-------------------    SUMMARY OF IMPORTATION   --------------------------------------")
-    print("--------------------------------------------------------------------------------------\n")
-    for i in list_already_imported:
-        print(i)
-        download_report.write(i)
-    print("\n------------------------------------------------------------------------------------")
-    for i in list_imported:
-        print(i)
-        download_report.write(i)
-    print("\n------------------------------------------------------------------------------------")
-    for i in list_warning:
-        print(i)
-        download_report.write(i)
-    print("\n------------------------------------------------------------------------------------")
-    print("------------------------------------------------------------------------------------\n")
-    download_report.close()
+    _print_import_summary(list_already_imported, list_imported, list_warning)
     
-    if dry_run:
-        print("\n NO IMPORTATION, DRY-RUN OPTION IS TRUE \n")
+    print('\n')
+    # dcm2niix does not overwrite files: remove outputs of previous
+    # or interrupted conversions
+    for out_dir, filename in series_to_record:
+        for output in glob.glob(glob.escape(os.path.join(out_dir, filename)) + '.*'):
+            os.remove(output)
+
+    def record_series(out_dir, filename):
+        dicom_path, source_fingerprint = series_to_record[(out_dir, filename)]
+        series = os.path.relpath(os.path.join(out_dir, filename), target_root_path)
+        record_import_manifest(target_root_path, manifest, series,
+                               dicom_path, source_fingerprint)
+
+    def log_conversion(status):
+        output = os.path.join(status['out_dir'], status['filename'])
+        dicom_path, source_fingerprint = series_to_record[
+            (status['out_dir'], status['filename'])]
+        log_import_event(download_report, 'convert', status['status'],
+                         seconds=status.get('seconds', 0.),
+                         bytes_in=source_fingerprint['size'],
+                         bytes_out=_files_size(
+                             glob.glob(glob.escape(output) + '.*')),
+                         source=dicom_path,
+                         target=os.path.relpath(output, target_root_path),
+                         message=status['message'])
+
+    start = time.time()
+    if converter == 'dcm2niix' and shutil.which('dcm2niix'):
+        def report_conversion(status):
+            if status['status'] == 'converted':
+                record_series(status['out_dir'], status['filename'])
+            message = (f"\n CONVERSION {status['status'].upper()}: "
+                       f"{status['in_dir']} -> "
+                       f"{os.path.join(status['out_dir'], status['filename'])}"
+                       f" ({status['seconds']:.1f} s, "
+                       f"{status['attempts']} attempt(s)) {status['message']}")
+            print(message)
+            log_conversion(status)
+
+        dcm2nii_convert(infiles_dcm2nii, DCM2NII_OPTIONS,
+                        nb_workers=nb_workers,
+                        timeout=conversion_timeout,
+                        retries=conversion_retries,
+                        callback=report_conversion,
+                        pool=thread_pool)
     else:
-        print('\n')
         cmd = "dcm2niibatch %s"%(dcm2nii_batch_file)
-        subprocess.call(cmd, shell=True)  
-    
-        # loop for checking if downloaded are ok and create the downloaded files
-    #    done_file = open(os.path.join(sub_path, 'downloaded'), 'w')
-    #    done_file.close()
-        
-        
-        #Data to deface
-        #print(files_for_pydeface)
-        if files_for_pydeface :
-            try:
-                template = ("/neurospin/unicog/protocols/IRMf/Unicogfmri/BIDS/"
-                            "unicog-dev/bids/template_deface/mean_reg2mean.nii.gz")
-                facemask = ("/neurospin/unicog/protocols/IRMf/Unicogfmri/BIDS/"
-                            "unicog-dev/bids/template_deface/facemask.nii.gz")
-            except:
-                template = resource_filename(Requirement.parse("unicog"),
-                                "bids/template_deface/mean_reg2mean.nii.gz")
-                facemask = resource_filename(Requirement.parse("unicog"),
-                                "bids/template_deface/facemask.nii.gz")
-            os.environ['FSLDIR'] = "/i2bm/local/fsl/bin/"
-            os.environ['FSLOUTPUTTYPE'] = "NIFTI_PAIR"
-            os.environ['PATH'] = os.environ['FSLDIR']+":"+os.environ['PATH']
-            
-            
-            for file_to_deface in files_for_pydeface:
-                print(f"\nDeface with pydeface {file_to_deface}") 
-                pdu.deface_image(infile=file_to_deface, 
-                                     outfile=file_to_deface, 
-                                     facemask=facemask,
-                                     template=template,
-                                     force=True)  
+        with _acquisition_server():
+            subprocess.call(cmd, shell=True)  
+        for out_dir, filename in series_to_record:
+            # Only the wall time of the whole batch is known
+            status = {'out_dir': out_dir, 'filename': filename,
+                      'status': 'failed', 'message': ''}
+            if glob.glob(glob.escape(os.path.join(out_dir, filename)) + '.nii*'):
+                record_series(out_dir, filename)
+                status['status'] = 'converted'
+            log_conversion(status)
+    log_import_event(download_report, 'convert', 'total',
+                     seconds=time.time() - start,
+                     bytes_in=sum(fingerprint['size'] for _, fingerprint
+                                  in series_to_record.values()),
+                     bytes_out=_files_size(
+                         [output for out_dir, filename in series_to_record
+                          for output in glob.glob(glob.escape(
+                              os.path.join(out_dir, filename)) + '.*')]),
+                     nb_series=len(series_to_record))
+
+    def report_meg(status):
+        message = (f"\n MEG CONVERSION {status['status'].upper()}: "
+                   f"{status['source']} -> "
+                   f"{os.path.join(status['target_path'], status['filename'])}"
+                   f" ({status['seconds']:.1f} s, empty room: "
+                   f"{status['empty_room']}) {status['message']}")
+        print(message)
+        log_import_event(download_report, 'meg', status['status'],
+                         seconds=status['seconds'],
+                         bytes_in=_files_size([status['source']]),
+                         source=status['source'],
+                         target=os.path.relpath(
+                             os.path.join(status['target_path'],
+                                          status['filename']),
+                             target_root_path),
+                         empty_room=status['empty_room'],
+                         message=status['message'])
+
+    start = time.time()
+    convert_meg_runs(meg_runs, nb_workers=nb_workers, callback=report_meg,
+                     pool=process_pool, dataset_path=target_root_path)
+    log_import_event(download_report, 'meg', 'total',
+                     seconds=time.time() - start,
+                     bytes_in=_files_size([meg_run['source']
+                                           for meg_run in meg_runs]),
+                     nb_series=len(meg_runs))
+
+    # loop for checking if downloaded are ok and create the downloaded files
+#    done_file = open(os.path.join(sub_path, 'downloaded'), 'w')
+#    done_file.close()
     
-        # Create participants.tsv in dataset folder (take out NIP column)
-        participants_path = os.path.join(target_root_path, 'participants.tsv')
-        df_participant = pd.DataFrame.from_dict(dic_info_participants, orient="index")
-        df_participant.to_csv(participants_path, sep='\t')
     
-        if dict_descriptors:
-            #print(dict_descriptors)
-            # Adding a new key value pair in a json file such as taskname
-            for k, v in dict_descriptors.items():
-                with open(k, 'r+') as json_file:
-                    for key, val in v.items() :
-                        temp_json = json.load(json_file)
-                        temp_json[key] = val
-                        json_file.seek(0)
-                        json.dump(temp_json, json_file)
-                        json_file.truncate()
-    
-    
-        # Copy recorded event files
-        if copy_events == "y" :
-            bids_copy_events(behav_path, data_root_path, dataset_name)
-     
-     
-        #Validate paths with BIDSValidator
-        #see also http://bids-standard.github.io/bids-validator/
-        validation_bids = yes_no('\nDo you want to use a bids validator? (y/n)')
-        if validation_bids:
-            bids_validation_report = os.path.join(report_path, "report_bids_valisation.txt")
-            if shutil.which('bids-validator'):
-                cmd = f"bids-validator {target_root_path} > {bids_validation_report}"
-                subprocess.call(cmd, shell=True)  
-                cmd = f"cat < {bids_validation_report}"
-                subprocess.call(cmd, shell=True) 
-                print('\n\nSee the summary of bids validator at {bids_validation_report}')
-            else:
-                validator = BIDSValidator()
-                os.chdir(target_root_path)
-                for file_to_test in  Path('.').glob('./**/*'):
-                    if file_to_test .is_file():
-                        file_to_test  = '/'+str(file_to_test )
-                        print('\nTest the following name of file : {name} with BIDSValidator'.format(name=file_to_test))
-                        print(validator.is_bids(file_to_test))
-                        
-    print('\n')                       
+    #Data to deface
+    if files_for_pydeface :
+        def report_deface(status):
+            message = (f"\n DEFACE {status['status'].upper()}: {status['file']}"
+                       f" ({status['seconds']:.1f} s) {status['message']}")
+            print(message)
+            size = _files_size([status['file']])
+            log_import_event(download_report, 'deface', status['status'],
+                             seconds=status['seconds'],
+                             bytes_in=size, bytes_out=size,
+                             target=os.path.relpath(status['file'],
+                                                    target_root_path),
+                             message=status['message'])
+            if status['status'] == 'defaced':
+                refresh_import_manifest(target_root_path, manifest,
+                                        status['file'])
+
+        start = time.time()
+        # Images imported in a previous run may be compressed
+        files_for_pydeface = [_nifti_path(file_for_pydeface)
+                              for file_for_pydeface in files_for_pydeface]
+        deface_images(files_for_pydeface,
+                      checksums_path=os.path.join(target_root_path,
+                                                  DEFACE_CHECKSUMS_FILE),
+                      nb_workers=nb_workers,
+                      callback=report_deface,
+                      pool=process_pool,
+                      fsl_dir=FSL_DIR)
+        log_import_event(download_report, 'deface', 'total',
+                         seconds=time.time() - start,
+                         nb_series=len(files_for_pydeface))
+
+    # Compress the converted images
+    files_to_compress = [os.path.join(out_dir, filename) + '.nii'
+                         for out_dir, filename in series_to_record]
+    files_to_compress = [file_to_compress for file_to_compress
+                         in files_to_compress
+                         if os.path.isfile(file_to_compress)]
+    if compress_level is not None and files_to_compress:
+        def report_compression(status):
+            print(f"\n COMPRESSION {status['status'].upper()}: {status['file']}"
+                  f" ({status['seconds']:.1f} s, {status['bytes_in']} -> "
+                  f"{status['bytes_out']} bytes) {status['message']}")
+            log_import_event(download_report, 'compress', status['status'],
+                             seconds=status['seconds'],
+                             bytes_in=status['bytes_in'],
+                             bytes_out=status['bytes_out'],
+                             target=os.path.relpath(status['file'],
+                                                    target_root_path),
+                             message=status['message'])
+
+        start = time.time()
+        statuses = compress_dataset(target_root_path, files_to_compress,
+                                    level=compress_level,
+                                    nb_workers=nb_workers, pool=thread_pool,
+                                    manifest=manifest,
+                                    callback=report_compression)
+        log_import_event(download_report, 'compress', 'total',
+                         seconds=time.time() - start,
+                         bytes_in=sum(status['bytes_in']
+                                      for status in statuses),
+                         bytes_out=sum(status['bytes_out']
+                                       for status in statuses),
+                         nb_series=len(statuses))
+
+    # Create participants.tsv in dataset folder (take out NIP column)
+    participants_path = os.path.join(target_root_path, 'participants.tsv')
+    df_participant.to_csv(participants_path, sep='\t')
+
+    # Adding a new key value pair in a json file such as taskname
+    def report_sidecar(status):
+        log_import_event(download_report, 'sidecar', status['status'],
+                         bytes_out=_files_size([status['file']]),
+                         target=os.path.relpath(status['file'],
+                                                target_root_path),
+                         message=status['message'])
+        if status['status'] == 'updated':
+            refresh_import_manifest(target_root_path, manifest, status['file'])
+        else:
+            print(f"\n WARNING: {status['file']} not updated: {status['message']}")
+
+    start = time.time()
+    update_json_sidecars(dict_descriptors, nb_workers=nb_workers,
+                         callback=report_sidecar, pool=thread_pool)
+    log_import_event(download_report, 'sidecar', 'total',
+                     seconds=time.time() - start,
+                     bytes_out=_files_size(dict_descriptors),
+                     nb_series=len(dict_descriptors))
+
+
+    compact_import_manifest(target_root_path, manifest)
+
+    # Copy recorded event files
+    if copy_events == "y" :
+        start = time.time()
+        copied = bids_copy_events(behav_path, data_root_path, dataset_name,
+                                  mode=events_mode, nb_workers=nb_workers,
+                                  pool=thread_pool)
+        for dst, status in copied.items():
+            log_import_event(download_report, 'events', status,
+                             bytes_out=(0 if status == 'skipped'
+                                        else _files_size([dst])),
+                             target=os.path.relpath(dst, target_root_path))
+        log_import_event(download_report, 'events', 'total',
+                         seconds=time.time() - start,
+                         bytes_out=_files_size([dst for dst, status
+                                                in copied.items()
+                                                if status != 'skipped']),
+                         nb_series=len(copied))
+        for status in sorted(set(copied.values())):
+            print(f"\n EVENTS FILES {status.upper()}: "
+                  f"{list(copied.values()).count(status)}")
+ 
+ 
+    #Validate paths with BIDSValidator
+    #see also http://bids-standard.github.io/bids-validator/
+    validation_bids = _answer(config, 'validate',
+                              '\nDo you want to use a bids validator? (y/n)')
+    if validation_bids:
+        start = time.time()
+        bids_validation_report = os.path.join(report_path, "report_bids_valisation.txt")
+        if shutil.which('bids-validator'):
+            cmd = f"bids-validator {target_root_path} > {bids_validation_report}"
+            subprocess.call(cmd, shell=True)  
+            log_import_event(download_report, 'validate', 'total',
+                             seconds=time.time() - start,
+                             report=bids_validation_report)
+            cmd = f"cat < {bids_validation_report}"
+            subprocess.call(cmd, shell=True) 
+            print('\n\nSee the summary of bids validator at {bids_validation_report}')
+        else:
+            summary = bids_validate_files(target_root_path, nb_workers=nb_workers,
+                                          pool=process_pool)
+            for path in summary['invalid']:
+                log_import_event(download_report, 'validate', 'invalid',
+                                 target=path.lstrip('/'))
+            log_import_event(download_report, 'validate', 'total',
+                             seconds=time.time() - start,
+                             nb_series=summary['nb_files'],
+                             nb_checked=summary['nb_checked'],
+                             nb_valid=summary['nb_valid'])
+            bids_validation_report = os.path.join(report_path, "report_bids_validation.json")
+            with open(bids_validation_report, 'w') as fid:
+                json.dump(summary, fid, indent=1)
+            print(f"\nBIDSValidator: {summary['nb_valid']}/{summary['nb_files']} "
+                  f"valid file names ({summary['nb_checked']} checked)")
+            for path in summary['invalid']:
+                print(f" NOT BIDS: {path}")
+            print(f'\n\nSee the summary of bids validator at {bids_validation_report}')
+    download_report.close()
+
+    print('\n')
+    print(summarize_import_log(download_report_path).to_string())
+    print(f'\nSee the import events at {download_report_path}\n')
+    return plan
+
+
+# Keys of a study of a batch manifest: arguments of bids_acquisition_download
+BATCH_STUDY_KEYS = {'root_path': 'data_root_path',
+                    'dataset_name': 'dataset_name',
+                    'force_download': 'force_download',
+                    'behav_path': 'behav_path',
+                    'copy_events': 'copy_events',
+                    'events_mode': 'events_mode',
+                    'deface': 'deface',
+                    'converter': 'converter',
+                    'conversion_timeout': 'conversion_timeout',
+                    'conversion_retries': 'conversion_retries',
+                    'hash_series': 'hash_series',
+                    'plan_output': 'plan_output',
+                    'compress_level': 'compress_level',
+                    'config': 'config'}
+
+
+def load_batch_manifest(manifest_path):
+    """Studies of a batch importation, from a yaml/json manifest.
+
+    The manifest has a 'studies' list and optional 'nb_workers',
+    'server_jobs' and 'nb_studies' (see bids_batch_download). A study has
+    a root_path (directory containing exp_info) and optional keys of
+    BATCH_STUDY_KEYS; its config is a file (see load_import_config) or the
+    config itself. Relative paths are relative to the manifest directory.
+
+    Returns the manifest with, for each study, the keyword arguments of
+    bids_acquisition_download. All the errors are raised together.
+    """
+    with open(manifest_path) as fid:
+        batch = yaml.safe_load(fid) or {}
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    errors = []
+    unknown = set(batch) - {'studies', 'nb_workers', 'server_jobs',
+                            'nb_studies'}
+    if unknown:
+        errors.append(f"unknown keys {sorted(unknown)}")
+    studies = []
+    datasets = set()
+    for i, study in enumerate(batch.get('studies') or []):
+        if not isinstance(study, dict) or 'root_path' not in study:
+            errors.append(f"study {i}: no root_path")
+            continue
+        unknown = set(study) - set(BATCH_STUDY_KEYS)
+        if unknown:
+            errors.append(f"study {i}: unknown keys {sorted(unknown)}")
+        kwargs = {BATCH_STUDY_KEYS[key]: value for key, value in study.items()
+                  if key in BATCH_STUDY_KEYS}
+        for key in ('data_root_path', 'plan_output'):
+            if kwargs.get(key) is not None:
+                kwargs[key] = os.path.join(manifest_dir, kwargs[key])
+        # No question in a batch: missing answers take their default value
+        config = kwargs.get('config') or {}
+        if isinstance(config, str):
+            config = load_import_config(os.path.join(manifest_dir, config))
+        kwargs['config'] = config
+        kwargs.setdefault('deface', bool(config.get('deface', False)))
+        if kwargs.get('copy_events') in (True, False):
+            kwargs['copy_events'] = 'y' if kwargs['copy_events'] else 'n'
+        dataset = get_bids_default_path(kwargs['data_root_path'],
+                                        kwargs.get('dataset_name'))[1]
+        if os.path.abspath(dataset) in datasets:
+            errors.append(f"study {i}: dataset {dataset} imported twice")
+        datasets.add(os.path.abspath(dataset))
+        studies.append(kwargs)
+    if not studies:
+        errors.append("no study")
+    if errors:
+        raise Exception(f"Invalid batch manifest {manifest_path}:\n"
+                        + "\n".join(errors))
+    batch['studies'] = studies
+    return batch
+
+
+def bids_batch_download(manifest_path, nb_workers=None, server_jobs=None,
+                        nb_studies=None, dry_run=False):
+    """Import all the studies of a batch manifest (see load_batch_manifest).
+
+    Studies are imported concurrently, nb_studies at a time (by default
+    all of them), sharing one thread pool and one process pool of
+    nb_workers (by default the number of CPUs): while a study converts
+    series, another one plans or defaces. At most server_jobs series are
+    read at the same time from the acquisition server by all the studies
+    (see set_acquisition_server_jobs). The arguments override those of the
+    manifest.
+
+    Returns {dataset path: import plan, or the exception of a failed
+    importation}. A failed importation does not stop the others.
+    The worker processes import __main__ again: call it under
+    if __name__ == '__main__' (see _process_pool).
+    """
+    global _acquisition_server_slots
+    batch = load_batch_manifest(manifest_path)
+    studies = batch['studies']
+    nb_workers = nb_workers or batch.get('nb_workers') or os.cpu_count()
+    server_jobs = server_jobs or batch.get('server_jobs')
+    nb_studies = nb_studies or batch.get('nb_studies') or len(studies)
+
+    previous_slots = _acquisition_server_slots
+    set_acquisition_server_jobs(server_jobs)
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=nb_workers) as thread_pool, \
+                _process_pool(nb_workers) as process_pool, \
+                ThreadPoolExecutor(max_workers=nb_studies) as study_pool:
+            jobs = {}
+            for study in studies:
+                dataset = get_bids_default_path(study['data_root_path'],
+                                                study.get('dataset_name'))[1]
+                jobs[study_pool.submit(bids_acquisition_download,
+                                       nb_workers=nb_workers,
+                                       dry_run=dry_run,
+                                       thread_pool=thread_pool,
+                                       process_pool=process_pool,
+                                       **study)] = dataset
+            for job in as_completed(jobs):
+                dataset = jobs[job]
+                try:
+                    results[dataset] = job.result()
+                except Exception as error:
+                    results[dataset] = error
+                    print(f"\n STUDY FAILED: {dataset}: {error}")
+                else:
+                    print(f"\n STUDY DONE: {dataset}")
+    finally:
+        _acquisition_server_slots = previous_slots
+    return results
+
 
 if __name__ == "__main__":
     # Parse arguments from console
@@ -753,6 +2439,13 @@ if __name__ == "__main__":
                         nargs=1,
                         default=['n'],
                         help='copy events from a directory with the same structure')
+    parser.add_argument('-events_mode',
+                        type=str,
+                        nargs=1,
+                        default=['copy'],
+                        choices=['copy', 'hardlink', 'reflink'],
+                        help='copy the events files, hard link them or clone '
+                             'them on copy-on-write file systems')
     parser.add_argument('-neurospin_database',
                         type=str,
                         nargs=1,
@@ -763,14 +2456,104 @@ if __name__ == "__main__":
                         nargs=1,
                         default=[False],
                         help='Test without importation of data')
+    parser.add_argument('-config',
+                        type=str,
+                        nargs=1,
+                        default=[None],
+                        help='yaml/json file answering the questions of the '
+                             'importation, see import_config_template.yaml')
+    parser.add_argument('-plan_output',
+                        type=str,
+                        nargs=1,
+                        default=[None],
+                        help='save the import plan in this .json or .tsv file')
+    parser.add_argument('-converter',
+                        type=str,
+                        nargs=1,
+                        default=['dcm2niix'],
+                        choices=['dcm2niix', 'dcm2niibatch'],
+                        help='dcm2niix: one process per series, '
+                             'dcm2niibatch: one process for all series')
+    parser.add_argument('-nb_workers',
+                        type=int,
+                        nargs=1,
+                        default=[None],
+                        help='maximum number of parallel conversions, '
+                             'by default the number of CPUs')
+    parser.add_argument('-conversion_timeout',
+                        type=float,
+                        nargs=1,
+                        default=[None],
+                        help='maximum time in seconds to convert a series')
+    parser.add_argument('-conversion_retries',
+                        type=int,
+                        nargs=1,
+                        default=[0],
+                        help='number of retries of a failed conversion')
+    parser.add_argument('-hash_series',
+                        action='store_true',
+                        help='detect changed DICOM series by hashing their '
+                             'content, not only by file sizes and dates')
+    parser.add_argument('-server_jobs',
+                        type=int,
+                        nargs=1,
+                        default=[None],
+                        help='maximum number of series read at the same time '
+                             'from the acquisition server')
+    parser.add_argument('-compress_level',
+                        type=int,
+                        nargs=1,
+                        default=[None],
+                        choices=range(1, 10),
+                        help='compress the converted images into .nii.gz '
+                             'with this level, 1 (fast) to 9 (small)')
+    parser.add_argument('-compress_dataset',
+                        type=str,
+                        nargs=1,
+                        default=[None],
+                        help='compress the .nii files of an existing dataset '
+                             'in place (level of -compress_level, default 6) '
+                             'and exit')
+    parser.add_argument('-batch',
+                        type=str,
+                        nargs=1,
+                        default=[None],
+                        help='yaml/json manifest of studies to import '
+                             'together, see batch_manifest_template.yaml')
     
     # LOAD CONSOLE ARGUMENTS
     args = parser.parse_args()
-    deface = yes_no('\nDo you want deface T1? (y/n)')
-    bids_acquisition_download(data_root_path=args.root_path[0],
-                              dataset_name=args.dataset_name[0],
-                              force_download=False,
-                              behav_path='exp_info/recorded_events',
-                              copy_events=args.copy_events[0],
-                              deface = deface,
-                              dry_run=args.dry_run[0])
+    if args.compress_dataset[0] is not None:
+        for status in compress_dataset(args.compress_dataset[0],
+                                       level=args.compress_level[0] or 6,
+                                       nb_workers=args.nb_workers[0]):
+            print(f"{status['status'].upper()}: {status['file']} "
+                  f"({status['bytes_in']} -> {status['bytes_out']} bytes) "
+                  f"{status['message']}")
+    elif args.batch[0] is not None:
+        bids_batch_download(args.batch[0],
+                            nb_workers=args.nb_workers[0],
+                            server_jobs=args.server_jobs[0],
+                            dry_run=args.dry_run[0])
+    else:
+        set_acquisition_server_jobs(args.server_jobs[0])
+        config = None
+        if args.config[0] is not None:
+            config = load_import_config(args.config[0])
+        deface = _answer(config, 'deface', '\nDo you want deface T1? (y/n)')
+        bids_acquisition_download(data_root_path=args.root_path[0],
+                                  dataset_name=args.dataset_name[0],
+                                  force_download=False,
+                                  behav_path='exp_info/recorded_events',
+                                  copy_events=args.copy_events[0],
+                                  deface = deface,
+                                  dry_run=args.dry_run[0],
+                                  converter=args.converter[0],
+                                  nb_workers=args.nb_workers[0],
+                                  conversion_timeout=args.conversion_timeout[0],
+                                  conversion_retries=args.conversion_retries[0],
+                                  hash_series=args.hash_series,
+                                  plan_output=args.plan_output[0],
+                                  events_mode=args.events_mode[0],
+                                  config=config,
+                                  compress_level=args.compress_level[0])
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the import planner and of the dataset catalog on fake trees
+organised as the NeuroSpin databases.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import neurospin_to_bids as nsb
+
+
+PARTICIPANTS = (
+    'participant_id\tNIP\tinfos_participant\tsession_label\tacq_date\t'
+    'acq_label\tlocation\tto_import\n'
+    'sub-01\tab123456\t{{"sex":"F"}}\t01\t2020-01-01\t\t{mri}\t'
+    "(('2','anat','T1w'),('3','func','task-loc_run-01_bold'),"
+    "('9','func','task-loc_run-02_bold'))\n"
+    'sub-01\tab123456\t{{"sex":"F"}}\t01\t2020-01-01\t\t{meg}\t'
+    "(('run1.fif','meg','task-rest_meg'),"
+    "('run2.fif','meg','task-rest_run-02_meg'))\n"
+    'sub-02\tcd789012\t{{"sex":"M"}}\t\t2020-01-01\t\t{mri}\t'
+    "(('2','anat','T1w'),)\n")
+
+
+def make_fake_tree(root):
+    """Fake MRI and MEG databases and exp_info/participants.tsv"""
+    mri = os.path.join(root, 'mri_db')
+    for series in ('000002_t1_mprage', '000003_loc_run1'):
+        series_path = os.path.join(mri, '20200101', 'ab123456-1234', series)
+        os.makedirs(series_path)
+        with open(os.path.join(series_path, 'image.dcm'), 'w') as fid:
+            fid.write(series)
+    meg = os.path.join(root, 'meg_db')
+    os.makedirs(os.path.join(meg, 'ab123456', '20200101'))
+    open(os.path.join(meg, 'ab123456', '20200101', 'run1.fif'), 'w').close()
+    os.makedirs(os.path.join(root, 'exp_info'))
+    with open(os.path.join(root, 'exp_info', 'participants.tsv'), 'w') as fid:
+        fid.write(PARTICIPANTS.format(mri=mri, meg=meg))
+    return mri, meg
+
+
+def test_plan_import(tmp_path):
+    root = str(tmp_path)
+    mri, meg = make_fake_tree(root)
+    nsb.clear_acquisition_index()
+    plan, participants = nsb.plan_import(root)
+
+    targets = [os.path.join(target_path, filename) for target_path, filename
+               in zip(plan['target_path'], plan['filename'])]
+    assert targets == [
+        'sub-01/ses-01/anat/sub-01_ses-01_T1w.nii',
+        'sub-01/ses-01/func/sub-01_ses-01_task-loc_run-01_bold.nii',
+        'sub-01/ses-01/func/sub-01_ses-01_task-loc_run-02_bold.nii',
+        'sub-01/ses-01/meg/sub-01_ses-01_task-rest_meg.fif',
+        'sub-01/ses-01/meg/sub-01_ses-01_task-rest_run-02_meg.fif',
+        'sub-02/anat/sub-02_T1w.nii']
+    assert list(plan['status']) == ['convert', 'convert', 'not_found',
+                                    'convert', 'not_found', 'no_nip_dir']
+    nip_dir = os.path.join(mri, '20200101', 'ab123456-1234')
+    assert list(plan['source'][:2]) == [
+        os.path.join(nip_dir, '000002_t1_mprage'),
+        os.path.join(nip_dir, '000003_loc_run1')]
+    assert plan['source'][3] == os.path.join(meg, 'ab123456', '20200101',
+                                             'run1.fif')
+    assert plan['source_fingerprint'][0]['nb_files'] == 1
+    assert participants.loc['sub-01', 'sex'] == 'F'
+    # nothing is written by the planner
+    assert sorted(os.listdir(root)) == ['exp_info', 'meg_db', 'mri_db']
+
+
+def test_new_series_found(tmp_path):
+    root = str(tmp_path)
+    mri, _ = make_fake_tree(root)
+    nsb.clear_acquisition_index()
+    assert nsb.find_series_dirs(mri, '20200101', 'ab123456', 9)[1] == []
+    # a series added to the NIP directory is seen before the index expires
+    series_path = os.path.join(mri, '20200101', 'ab123456-1234',
+                               '000009_loc_run2')
+    time.sleep(0.01)
+    os.makedirs(series_path)
+    assert nsb.find_series_dirs(mri, '20200101', 'ab123456', 9)[1] == [
+        series_path]
+
+
+def test_bids_catalog(tmp_path):
+    root = str(tmp_path)
+    anat = os.path.join(root, 'sub-01', 'anat')
+    os.makedirs(anat)
+    open(os.path.join(anat, 'sub-01_T1w.nii'), 'w').close()
+    catalog_path = os.path.join(root, nsb.BIDS_CATALOG_FILE)
+
+    catalog = nsb.load_bids_catalog(root)
+    assert nsb.query_bids_catalog(catalog, [('file_tag', 'T1w')]) == [
+        os.path.join(anat, 'sub-01_T1w.nii')]
+    # an unchanged dataset does not rewrite the catalog
+    saved = os.stat(catalog_path).st_mtime_ns
+    time.sleep(0.01)
+    nsb.load_bids_catalog(root)
+    assert os.stat(catalog_path).st_mtime_ns == saved
+
+    time.sleep(0.01)
+    open(os.path.join(anat, 'sub-01_T2w.nii'), 'w').close()
+    catalog = nsb.load_bids_catalog(root)
+    assert nsb.query_bids_catalog(catalog, [('sub', '01')]) == [
+        os.path.join(anat, 'sub-01_T1w.nii'),
+        os.path.join(anat, 'sub-01_T2w.nii')]
@@ -8,27 +8,10 @@ SCRIPT DEMO: MULTIPLICATION OF IMAGES
 """
 
 
-import nibabel
+from unicogfmri.utils_unicogfmri.utils import utils
 
 
-#multiplication of images
-#load image
-img1 = nibabel.load("imageA.nii")
-img2 = nibabel.load("imageB.nii")
-
-#load data
-tab1 = img1.get_data()
-tab2 = img2.get_data()
-
-#operation on data
-tab3 = tab1 * tab2
-
-#load affine
-aff = img1.get_affine()
-
-#load header to avoid the loss of information
-header = img1.get_header()
-
-#save data
-new_image = nibabel.Nifti1Image(tab3, aff, header)
-nibabel.save(new_image, "new_image")
\ No newline at end of file
+#multiplication of images, computed by chunks of z planes so that the images
+#are never loaded whole. The affine and the header of imageA are kept.
+utils.image_math("a * b", {"a": "imageA.nii", "b": "imageB.nii"},
+                 "new_image.nii")
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Round trips of the ROI data written by save_data_from_rois
+"""
+
+import os.path as op
+from collections import OrderedDict
+
+import numpy as np
+import nibabel
+import pytest
+
+from unicogfmri.utils_unicogfmri.utils import utils
+
+
+EXTENSIONS = {'txt': '.dat', 'npy': '.npy', 'hdf5': '.h5'}
+
+
+def make_maps_and_rois(path):
+    """ 3 random maps and 2 box ROIs of 4x5x6 voxels """
+    rng = np.random.RandomState(0)
+    affine = np.diag([3., 3., 3., 1.])
+    maps = OrderedDict()
+    for name in ('con1', 'con2', 'con3'):
+        maps[name] = op.join(path, name + '.nii')
+        nibabel.save(nibabel.Nifti1Image(
+            rng.randn(4, 5, 6).astype(np.float32), affine), maps[name])
+    rois = OrderedDict()
+    for name, box in (('left', np.s_[:2, :3, :]),
+                      ('right', np.s_[2:, 1:4, 2:5])):
+        mask = np.zeros((4, 5, 6), np.uint8)
+        mask[box] = 1
+        rois[name] = op.join(path, name + '.nii')
+        nibabel.save(nibabel.Nifti1Image(mask, affine), rois[name])
+    return maps, rois
+
+
+@pytest.mark.parametrize('fmt', ['txt', 'npy', 'hdf5'])
+def test_save_read_data_from_rois(tmp_path, fmt):
+    if fmt == 'hdf5':
+        pytest.importorskip('h5py')
+    maps, rois = make_maps_and_rois(str(tmp_path))
+    expected = utils.extract_data_in_rois(list(maps.values()),
+                                          list(rois.values()))
+    prefix = op.join(str(tmp_path), 'out_')
+    utils.save_data_from_rois(maps, rois, prefix=prefix, fmt=fmt)
+
+    for name, roi_expected in zip(rois, expected):
+        data, columns = utils.read_data_from_roi(prefix + name +
+                                                 EXTENSIONS[fmt])
+        assert columns == list(maps)
+        assert data.shape == (roi_expected.shape[0], len(maps))
+        np.testing.assert_allclose(data, roi_expected, rtol=1e-6)
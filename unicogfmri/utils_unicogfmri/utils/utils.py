@@ -2,17 +2,22 @@
 
 from glob import glob
 import os
+import json
 import os.path as op
+import itertools
 from collections import OrderedDict
+from functools import partial
+import multiprocessing
+import threading
 
 import pandas as pd
 import csv
 
 import numpy as np
 import nibabel
-from skimage import morphology
 from nilearn.input_data import NiftiMapsMasker
 from nilearn.masking import intersect_masks
+from nilearn.image import concat_imgs, resample_img
 
 from nilearn.masking import apply_mask
 from scipy.stats import scoreatpercentile
@@ -33,7 +38,7 @@ def get_rootdir():
     if rootdir is None:
         rootdir = rootdir
     if not rootdir:
-        print "no rootdir initialized"
+        print("no rootdir initialized")
     return rootdir
 
 
@@ -80,13 +85,29 @@ def get_maps_original():
     return OrderedDict(zip(names, maps))
 
 
-def extract_data_in_roi(scans, roi):
+def _mask_bounding_box(mask):
+    """
+    returns the slices of the smallest box containing the voxels of mask
+    """
+    coords = np.nonzero(mask)
+    if len(coords[0]) == 0:
+        return tuple(slice(0, 0) for _ in mask.shape)
+    return tuple(slice(c.min(), c.max() + 1) for c in coords)
+
+
+def extract_data_in_roi(scans, roi, lazy=False):
     """
     returns the values of voxels in scans that are inside the roi, as a matrix    (rows=voxels, columns=scans). 
     scans : list of 3D img files,
     roi : string, filename of mask file
+    lazy : if True, only the box around the roi is read from each scan
+           (through the memory-mapped image proxy) and the matrix has the
+           data type of the scans, instead of float64 with every scan
+           entirely loaded
     note: the current code assumes that mask and the scans have the same shape
     """
+    if lazy:
+        return _extract_data_in_roi_lazy(scans, roi)
     mask = nibabel.load(roi).get_data() > 0
     data = np.zeros([mask.shape[0], mask.shape[1], mask.shape[2], len(scans)])
     for i in range(len(scans)):
@@ -97,7 +118,178 @@ def extract_data_in_roi(scans, roi):
     return data[mask, :]
 
 
-def save_data_from_rois(maps, rois, prefix=''):
+def _extract_data_in_roi_lazy(scans, roi):
+    """
+    extract_data_in_roi reading only the voxels of the box around the roi
+    """
+    mask = np.asanyarray(nibabel.load(roi).dataobj) > 0
+    box = _mask_bounding_box(mask)
+    box_mask = mask[box]
+    data = None
+    for i, scan in enumerate(scans):
+        assert os.path.isfile(scan)
+        img = nibabel.load(scan)
+        assert img.shape == mask.shape
+        values = np.asanyarray(img.dataobj[box])[box_mask]
+        if data is None:
+            data = np.empty((box_mask.sum(), len(scans)), values.dtype)
+        elif not np.can_cast(values.dtype, data.dtype):
+            # scans of different data types
+            data = data.astype(np.result_type(data.dtype, values.dtype))
+        data[:, i] = values
+    if data is None:
+        data = np.empty((box_mask.sum(), 0))
+    return data
+
+
+def _rois_index(rois):
+    """
+    returns the shape of the masks of rois, the box around all of them, the
+    indices in this box of the voxels of every roi, concatenated, and the
+    offsets splitting them per roi
+    """
+    shape, union = None, None
+    masks = [np.asanyarray(nibabel.load(roi).dataobj) > 0 for roi in rois]
+    for mask in masks:
+        if shape is None:
+            shape, union = mask.shape, mask.copy()
+        assert mask.shape == shape
+        union |= mask
+    box = _mask_bounding_box(union)
+    indices = [np.flatnonzero(mask[box]) for mask in masks]
+    offsets = np.cumsum([len(index) for index in indices])[:-1]
+    return shape, box, np.concatenate(indices), offsets
+
+
+def _read_voxels(scan, shape, box, index):
+    """
+    returns the values of a scan at the indices of the voxels of box
+    """
+    assert os.path.isfile(scan)
+    img = nibabel.load(scan)
+    assert img.shape == shape
+    return np.asanyarray(img.dataobj[box]).ravel()[index]
+
+
+def _n_jobs(n_jobs):
+    """
+    returns the number of processes of n_jobs, -1 meaning all the CPUs
+    """
+    if n_jobs < 0:
+        return max(1, multiprocessing.cpu_count() + 1 + n_jobs)
+    return n_jobs
+
+
+def _parallel_map(func, items, n_jobs=1):
+    """
+    returns [func(item) for item in items], computed on a pool of n_jobs
+    processes (-1 for all the CPUs)
+    """
+    items = list(items)
+    n_jobs = min(_n_jobs(n_jobs), len(items))
+    if n_jobs <= 1:
+        return [func(item) for item in items]
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_data_in_rois(scans, rois, n_jobs=1):
+    """
+    yields, for each scan in order, the list of the values of its voxels
+    inside each roi. Every scan is read once (only the box around the rois),
+    whatever the number of rois.
+    scans : list of 3D img files
+    rois : list of mask files, which may overlap
+    n_jobs : number of processes reading the scans, -1 for all the CPUs
+    """
+    assert len(rois) != 0
+    shape, box, index, offsets = _rois_index(rois)
+    read = partial(_read_voxels, shape=shape, box=box, index=index)
+    n_jobs = _n_jobs(n_jobs)
+    if n_jobs == 1:
+        for scan in scans:
+            yield np.split(read(scan), offsets)
+        return
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        chunksize = max(1, len(scans) // (4 * n_jobs))
+        for values in pool.imap(read, scans, chunksize):
+            yield np.split(values, offsets)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def extract_data_in_rois(scans, rois, n_jobs=1):
+    """
+    returns, for each roi, the matrix of the values of its voxels in scans
+    (rows=voxels, columns=scans), in the data type of the scans.
+    Same as extract_data_in_roi for each roi, but every scan is read once.
+    scans : list of 3D img files,
+    rois : list of mask files
+    n_jobs : number of processes reading the scans
+    """
+    data = None
+    for i, values in enumerate(iter_data_in_rois(scans, rois, n_jobs)):
+        if data is None:
+            data = [np.empty((len(v), len(scans)), v.dtype) for v in values]
+        for r, v in enumerate(values):
+            if not np.can_cast(v.dtype, data[r].dtype):
+                # scans of different data types
+                data[r] = data[r].astype(np.result_type(data[r].dtype,
+                                                        v.dtype))
+            data[r][:, i] = v
+    if data is None:
+        _, _, index, offsets = _rois_index(rois)
+        data = [np.empty((len(i), 0)) for i in np.split(index, offsets)]
+    return data
+
+
+def _data_dtype(scan):
+    """
+    returns the data type of the values of a scan, scaling included,
+    reading only its first voxel
+    """
+    img = nibabel.load(scan)
+    return np.asanyarray(img.dataobj[(0,) * len(img.shape)]).dtype
+
+
+def _open_roi_output(path, fmt, columns, shape, dtype):
+    """
+    creates the binary output file of a roi and returns an array written
+    in place on disk (npy memmap or hdf5 dataset) and the function closing
+    the file
+    """
+    if fmt == 'npy':
+        with open(path + '.json', 'w') as fid:
+            json.dump({'columns': list(columns)}, fid)
+        if 0 in shape:
+            # empty files cannot be memory-mapped
+            data = np.empty(shape, dtype)
+            return data, partial(np.save, path + '.npy', data)
+        data = np.lib.format.open_memmap(path + '.npy', mode='w+',
+                                         dtype=dtype, shape=shape,
+                                         fortran_order=True)
+        return data, data.flush
+    if fmt == 'hdf5':
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("fmt='hdf5' needs h5py")
+        h5 = h5py.File(path + '.h5', 'w')
+        data = h5.create_dataset('data', shape, dtype,
+                                 chunks=None if 0 in shape else True)
+        data.attrs['columns'] = np.array([c.encode('utf-8') for c in columns])
+        return data, h5.close
+    raise ValueError("unknown format %s, use 'txt', 'npy' or 'hdf5'" % fmt)
+
+
+def save_data_from_rois(maps, rois, prefix='', n_jobs=1, fmt='txt'):
     """
     extract data from the scans listed in maps, in each roi
     from the dictionary rois, and save in one text file per roi
@@ -105,12 +297,70 @@ def save_data_from_rois(maps, rois, prefix=''):
     maps: ordereddict names -> files
     roi : ordereddict names -> files
     prefix: prefix to be added in front of filenames
+    n_jobs: number of processes reading the maps
+    fmt: 'txt' (comma-separated <prefix><roi>.dat file with the map names
+         as header), 'npy' (<prefix><roi>.npy with the map names in
+         <prefix><roi>.json) or 'hdf5' (<prefix><roi>.h5, needs h5py, with
+         the map names in the 'columns' attribute of its 'data' dataset)
+    Every map is read once, whatever the number of rois. The binary files
+    are written map after map, without holding the data in memory.
+    Use read_data_from_roi to read the files back.
+    """
+    if fmt == 'txt':
+        activations = extract_data_in_rois(list(maps.values()),
+                                           list(rois.values()), n_jobs)
+        for nroi, roi_activations in zip(rois.keys(), activations):
+            np.savetxt('%s%s.dat' % (prefix, nroi), roi_activations,
+                       delimiter=',',
+                       header=",".join(maps.keys()), comments='')
+        return
+
+    scans = list(maps.values())
+    dtype = (np.result_type(*[_data_dtype(scan) for scan in scans])
+             if scans else np.float64)
+    outputs = None
+    try:
+        for i, values in enumerate(iter_data_in_rois(scans,
+                                                     list(rois.values()),
+                                                     n_jobs)):
+            if outputs is None:
+                outputs = [_open_roi_output('%s%s' % (prefix, nroi), fmt,
+                                            maps.keys(),
+                                            (len(v), len(scans)), dtype)
+                           for nroi, v in zip(rois.keys(), values)]
+            for (data, _), v in zip(outputs, values):
+                data[:, i] = v
+        if outputs is None:
+            _, _, index, offsets = _rois_index(list(rois.values()))
+            outputs = [_open_roi_output('%s%s' % (prefix, nroi), fmt,
+                                        maps.keys(), (len(i), 0), dtype)
+                       for nroi, i in zip(rois.keys(),
+                                          np.split(index, offsets))]
+    finally:
+        for _, close in outputs or []:
+            close()
+
+
+def read_data_from_roi(filename, mmap=True):
     """
-    for nroi, froi in rois.iteritems():
-        activations = extract_data_in_roi(maps.values(), froi)
-        np.savetxt('%s%s.dat' % (prefix, nroi), activations,
-                   delimiter=',',
-                   header=",".join(maps.keys()), comments='')
+    returns the matrix (rows=voxels, columns=maps) and the list of map names
+    of a file written by save_data_from_rois (.dat, .npy or .h5 file)
+    mmap: if True, a .npy matrix is memory-mapped instead of being loaded
+    """
+    ext = op.splitext(filename)[1]
+    if ext == '.npy':
+        with open(op.splitext(filename)[0] + '.json') as fid:
+            columns = json.load(fid)['columns']
+        return np.load(filename, mmap_mode='r' if mmap else None), columns
+    if ext == '.h5':
+        import h5py
+        with h5py.File(filename, 'r') as h5:
+            columns = [c.decode('utf-8') for c in h5['data'].attrs['columns']]
+            return h5['data'][...], columns
+    with open(filename) as fid:
+        columns = fid.readline().strip().split(',')
+    data = np.loadtxt(filename, delimiter=',', skiprows=1, ndmin=2)
+    return data.reshape(-1, len(columns)), columns
           
           
 ###############################################################################
@@ -120,10 +370,10 @@ and subject-specific localizer masks.
 """
 
 def binarize_img(img, threshold):
-    mask = img.get_data().copy()
+    mask = np.asanyarray(img.dataobj).copy()
     mask[mask < threshold] = 0.
     mask[mask >= threshold] = 1.
-    return nibabel.Nifti1Image(mask, img.get_affine())
+    return nibabel.Nifti1Image(mask, img.affine)
 
 def get_mask_size(mask_img):
     return np.sum(mask_img.get_data())
@@ -154,83 +404,194 @@ def create_localizer_mask(roi_img, localizer_img, loc_threshold):
 #    data = masker.fit_transform(nifti_obj)
 #    return data
 
-def get_data_in_roi(path_roi, data_file):
-    """Using of the NiftiMapsMasker """
-    masker = NiftiMapsMasker([path_roi])
-    array_datas = np.zeros((len(data_file), 177))
-    for e, d in enumerate(data_file):
-        nifti_obj = nibabel.load(d)
-        data = masker.fit_transform(d)
-        array_datas[e-1] = data.ravel()
-    return array_datas
+def _transform(masker, imgs):
+    """
+    returns masker.transform(imgs), for process pools
+    """
+    return masker.transform(imgs)
+
+
+def get_data_in_roi(path_roi, data_file, n_jobs=1):
+    """Using of the NiftiMapsMasker
+    returns the time series of the roi in each run of data_file, as a list
+    of 1D arrays (one per run, whatever their lengths; use np.array to get
+    a matrix of runs of the same length). The masker is fitted once and
+    all the volumes of a run are extracted at once.
+    data_file : a 4D img file, a list of 4D img files (one per run) or a
+                list of 3D img files (the volumes of one run)
+    n_jobs : number of processes extracting the runs, -1 for all the CPUs
+    """
+    if not isinstance(data_file, (list, tuple)):
+        runs = [data_file]
+    elif data_file and len(getattr(data_file[0], 'shape', None) or
+                           nibabel.load(data_file[0]).shape) == 3:
+        runs = [list(data_file)]
+    else:
+        runs = list(data_file)
+    masker = NiftiMapsMasker([path_roi]).fit()
+    return [data.ravel() for data in
+            _parallel_map(partial(_transform, masker), runs, n_jobs)]
 
 
 #def get_mean_epi_masked(epi_files, roi):
 #    return np.mean(apply_mask(epi_files, roi), axis=1)
 
 
-def get_data_in_rois_method1(ROIs, subjects, contrasts, condir):
-    """ returns the average contratst in each ROI and for each subject """
-    masker = NiftiMapsMasker(ROIs)
-    print ROIs
-    
+# ROI images and ROI stacks kept between calls, least recently used first
+# (see _lru_get)
+ROI_CACHE_SIZE = 64
+_roi_maps_cache = OrderedDict()
+_roi_cache = OrderedDict()
+
+
+def _lru_get(cache, key, make, max_size):
+    """
+    returns cache[key], computed by make() if missing, keeping the max_size
+    most recently used items of cache
+    """
+    if key in cache:
+        value = cache.pop(key)
+    else:
+        value = make()
+    cache[key] = value
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+    return value
+
+
+def clear_roi_cache():
+    """ empties the caches of ROI images and ROI stacks """
+    _roi_maps_cache.clear()
+    _roi_cache.clear()
+
+
+def _load_roi(roi):
+    """ returns the image of a ROI file, loaded in memory once """
+    def load():
+        img = nibabel.load(roi)
+        return nibabel.Nifti1Image(np.asanyarray(img.dataobj), img.affine)
+    return _lru_get(_roi_cache, (roi, op.getmtime(roi)), load, ROI_CACHE_SIZE)
+
+
+def _roi_maps(ROIs, vol):
+    """
+    returns the 4D image of the ROIs files resampled to the geometry of
+    the img file vol, computed once and cached on the ROI set and the
+    affine and shape of vol
+    """
+    ROIs = tuple(ROIs)
+    metadata = image_metadata(vol)
+    affine, shape = metadata['affine'], metadata['shape'][:3]
+
+    def resample():
+        maps = concat_imgs([_load_roi(roi) for roi in ROIs])
+        if maps.shape[:3] == shape and np.allclose(maps.affine, affine):
+            return maps
+        # interpolation of NiftiMapsMasker resampling its maps to the data
+        return resample_img(maps, target_affine=affine, target_shape=shape,
+                            interpolation='continuous')
+    key = (ROIs, tuple(op.getmtime(roi) for roi in ROIs), affine.tobytes(),
+           shape)
+    return _lru_get(_roi_maps_cache, key, resample, ROI_CACHE_SIZE)
+
+
+def _fitted_masker(ROIs, conlist, mask_img=None):
+    """
+    returns a NiftiMapsMasker of the ROIs files within mask_img, for the
+    contrasts files of conlist. The masker is cheap: the ROIs are loaded
+    and resampled to the contrasts once (see _roi_maps).
+    """
+    return NiftiMapsMasker(_roi_maps(ROIs, conlist[0]), mask_img).fit()
+
+
+def _subject_rois_values(sub, ROIs, contrasts, condir, method,
+                         localizerf=None, param=None):
+    """
+    returns the (contrasts, ROIs) average values of a subject with
+    method 1, 2 or 3 (see get_data_in_rois_method1/2/3)
+    """
+    conlist = [op.join(sub, condir, x) for x in contrasts]
+    if method == 1:
+        return _fitted_masker(ROIs, conlist).transform(conlist)
+    localizer_img = nibabel.load(op.join(sub, localizerf))
+    if method == 2:
+        locmask = binarize_img(localizer_img, param)
+        return _fitted_masker(ROIs, conlist, locmask).transform(conlist)
+    # method 3: contrasts are loaded once for all the ROIs
+    con_data = [np.asanyarray(nibabel.load(con).dataobj) for con in conlist]
+    values = np.zeros((len(contrasts), len(ROIs)))
+    for iroi, roi in enumerate(ROIs):
+        locmask = create_bestvoxels_mask(_load_roi(roi), localizer_img, param)
+        mask = np.asanyarray(locmask.dataobj) > 0
+        for icon, data in enumerate(con_data):
+            assert data.shape == mask.shape
+            values[icon, iroi] = np.mean(data[mask])
+    return values
+
+
+def _get_data_in_rois(ROIs, subjects, contrasts, condir, method,
+                      localizerf=None, param=None, n_jobs=1):
+    """
+    returns the (subjects, contrasts, ROIs) average values of
+    get_data_in_rois_method1/2/3, subjects being processed on a pool of
+    n_jobs processes
+    """
     values = np.zeros((len(subjects), len(contrasts), len(ROIs)))
-    for isub, sub in enumerate(subjects):
-        conlist = [op.join(sub, condir, x) for x in contrasts]
-        print conlist
-        res = masker.fit_transform(conlist)
-        values[isub, :] = masker.fit_transform(conlist)
-        #print values
+    for isub, sub_values in enumerate(_parallel_map(
+            partial(_subject_rois_values, ROIs=ROIs, contrasts=contrasts,
+                    condir=condir, method=method, localizerf=localizerf,
+                    param=param),
+            subjects, n_jobs)):
+        values[isub, :] = sub_values
     return values
 
 
-def get_data_in_rois_method2(ROIs, subjects, contrasts, condir, localizerf, threshold):
+def get_data_in_rois_method1(ROIs, subjects, contrasts, condir, n_jobs=1):
+    """ returns the average contratst in each ROI and for each subject """
+    return _get_data_in_rois(ROIs, subjects, contrasts, condir, 1,
+                             n_jobs=n_jobs)
+
+
+def get_data_in_rois_method2(ROIs, subjects, contrasts, condir, localizerf,
+                             threshold, n_jobs=1):
     """ returns, for individual subjects, the average contrasts values  in ROIs masked by individual localizers,
     thresholded at a fixed theshold"""
-    values = np.zeros((len(subjects), len(contrasts), len(ROIs)))
-    for isub, sub in enumerate(subjects):
-        conlist = [op.join(sub, condir, x) for x in contrasts]
-        localizer_img = nibabel.load(op.join(sub, localizerf))
-        locmask = binarize_img(localizer_img, threshold)
-        masker = NiftiMapsMasker(ROIs, locmask)
-        values[isub, :] = masker.fit_transform(conlist)
-    return values
+    return _get_data_in_rois(ROIs, subjects, contrasts, condir, 2,
+                             localizerf, threshold, n_jobs)
 
 
-def get_data_in_rois_method3(ROIs, subjects, contrasts, condir, localizerf, toppercentile):
+def get_data_in_rois_method3(ROIs, subjects, contrasts, condir, localizerf,
+                             toppercentile, n_jobs=1):
     """ returns, for individual subjects, the average contrasts values  in ROIs masked by individual localizers,
     tresholded to keep a toppertcentil voxels in each ROI. """
-    values = np.zeros((len(subjects), len(contrasts), len(ROIs)))
-    print ROIs
-    for isub, sub in enumerate(subjects):
-        conlist = [op.join(sub, condir, x) for x in contrasts]
-        localizer_img = nibabel.load(op.join(sub, localizerf))
-        for iroi, roi in enumerate(ROIs):
-            roi_img = nibabel.load(roi)
-            locmask = create_bestvoxels_mask(roi_img, localizer_img, toppercentile)
-            values[isub, :, iroi] = np.mean(apply_mask(conlist, locmask), axis=1)
-    return values
+    return _get_data_in_rois(ROIs, subjects, contrasts, condir, 3,
+                             localizerf, toppercentile, n_jobs)
 
 
 ##############
 
-def ndarray2df(v):
-    df = pd.DataFrame(columns=['Subject', 'ROI', 'contrast', 'beta'])
-
-    subj = [op.splitext(op.basename(fn))[0] for fn in subjects]
-    con = [op.splitext(op.basename(fn))[0] for fn in contrasts]
-    rois = [op.splitext(op.basename(fn))[0] for fn in ROIs]
-    n1, n2, n3 = v.shape
-    k=0
-    for i1 in range(n1):
-        for i2 in range(n2):
-            for i3 in range(n3):
-                df.loc[k] = pd.Series({'Subject': subj[i1],
-                                       'contrast': con[i2],
-                                       'ROI': rois[i3],
-                                       'beta': v[i1, i2, i3]})
-                k = k + 1
-    return df
+def ndarray2df(v, subjects, contrasts, ROIs, categorical=False):
+    """
+    returns the long table of the (subjects, contrasts, ROIs) array v of
+    get_data_in_rois_method1/2/3: one row per subject, contrast and ROI,
+    with columns Subject, ROI, contrast (the file names without extension
+    of subjects, contrasts and ROIs) and beta
+    categorical: if True, the labels are stored as categories to save memory
+    """
+    labels = [np.array([op.splitext(op.basename(fn))[0] for fn in names],
+                       dtype=object)
+              for names in (subjects, contrasts, ROIs)]
+    v = np.asarray(v)
+    assert v.shape == tuple(len(label) for label in labels)
+    indices = np.meshgrid(*[np.arange(n) for n in v.shape], indexing='ij')
+    columns = {}
+    for name, index, label in zip(['Subject', 'contrast', 'ROI'], indices,
+                                  labels):
+        columns[name] = label[index.ravel()]
+        if categorical:
+            columns[name] = pd.Categorical(columns[name])
+    columns['beta'] = v.ravel()
+    return pd.DataFrame(columns, columns=['Subject', 'ROI', 'contrast', 'beta'])
 
 
 ########
@@ -284,6 +645,58 @@ def analyze_average(data, onsets,
     return analyzer
     
 
+################
+# IMAGE METADATA
+################
+
+# Metadata of the images read by image_metadata, least recently used first
+METADATA_CACHE_SIZE = 256
+_metadata_cache = OrderedDict()
+_metadata_cache_stats = {'hits': 0, 'misses': 0}
+_metadata_cache_lock = threading.Lock()
+
+
+def image_metadata(vol):
+    """
+    returns a dict with the affine, shape, zooms and (on disk) dtype of an
+    img file, reading only its header.
+    The metadata are cached, keyed on the path, date and size of the file,
+    for the METADATA_CACHE_SIZE most recently used files of the process.
+    """
+    path = op.abspath(vol)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+
+    def read():
+        img = nibabel.load(path)
+        affine = np.array(img.affine)
+        # shared between callers: read-only
+        affine.flags.writeable = False
+        return {'affine': affine,
+                'shape': img.shape,
+                'zooms': img.header.get_zooms(),
+                'dtype': img.get_data_dtype()}
+
+    with _metadata_cache_lock:
+        _metadata_cache_stats['hits' if key in _metadata_cache
+                              else 'misses'] += 1
+        return _lru_get(_metadata_cache, key, read, METADATA_CACHE_SIZE)
+
+
+def metadata_cache_info():
+    """ returns the hits, misses, size and max_size of the metadata cache """
+    with _metadata_cache_lock:
+        return dict(_metadata_cache_stats, size=len(_metadata_cache),
+                    max_size=METADATA_CACHE_SIZE)
+
+
+def clear_metadata_cache():
+    """ empties the metadata cache and resets its counters """
+    with _metadata_cache_lock:
+        _metadata_cache.clear()
+        _metadata_cache_stats.update(hits=0, misses=0)
+
+
 ##############
 # COORDINATES
 ##############
@@ -311,39 +724,143 @@ def voxel_to_mm(vol, voxel_coords):
            [  90., -126.,  -70.]])
 
     """
-    img = nibabel.load(vol)
-    aff = img.get_affine()
-    mm_coords = nibabel.affines.apply_affine(aff, voxel_coords)
-    return mm_coords
+    return nibabel.affines.apply_affine(image_metadata(vol)['affine'],
+                                        voxel_coords)
+
+def _mm_to_voxel(affine, mm_coords):
+    """
+    returns the voxel coordinates of mm_coords ([x, y, z] or a list of
+    them), with one inverse of affine and one matrix product
+    """
+    inv = np.linalg.inv(affine)
+    return np.asarray(mm_coords, dtype=float).dot(inv[:3, :3].T) + inv[:3, 3]
 
 def mm_to_voxel(vol, mm_coords):
     """
     Get the coordinates in voxel by using the inverse of affine
+    All the coordinates are converted at once (see _mm_to_voxel)
     Example :
     utils.mm_to_voxel("T1.nii", [[90., -126.,  -72.]])
-    array([ 0.,  0.,  0.])    
+    array([[ 0.,  0.,  0.]])
     """
-    import numpy.linalg as npl
-    img = nibabel.load(vol)
-    aff = img.get_affine()
-    list_coord = []
-    for coord in mm_coords:
-        coords_voxel = nibabel.affines.apply_affine(npl.inv(aff), coord)
-        list_coord.append(coords_voxel)
-    return list_coord
+    return _mm_to_voxel(image_metadata(vol)['affine'], mm_coords)
+
+# Number of z planes (3D image) or volumes (4D image) read at once by
+# _values_at_voxels in compressed or scaled images
+SAMPLE_CHUNK_SIZE = 16
 
-def get_value_in_mm(vol, mm_x, mm_y, mm_z):
+def _is_mappable(img):
+    """
+    returns True if the data of img can be indexed without being read:
+    in memory, or uncompressed and unscaled on disk (memory-mapped)
+    """
+    if not nibabel.is_proxy(img.dataobj):
+        return True
+    filename = img.get_filename()
+    return (filename is not None and not filename.endswith('.gz') and
+            img.dataobj.slope == 1 and img.dataobj.inter == 0)
+
+def _values_at_voxels(img, index):
+    """
+    returns the values of img at the integer voxel coordinates index
+    (N, 3). Only these voxels are read from memory-mapped images (see
+    _is_mappable); other images are read through the image proxy, in the
+    box around index, SAMPLE_CHUNK_SIZE z planes (3D) or volumes (4D) at a
+    time, so that the box of scattered coordinates is never held whole.
+    """
+    index = tuple(index.T)
+    if _is_mappable(img):
+        return np.asanyarray(img.dataobj)[index]
+    box = tuple(slice(i.min(), i.max() + 1) for i in index)
+    local = tuple(i - b.start for i, b in zip(index, box))
+    values = None
+    if len(img.shape) == 3:
+        for start in range(box[2].start, box[2].stop, SAMPLE_CHUNK_SIZE):
+            stop = min(start + SAMPLE_CHUNK_SIZE, box[2].stop)
+            data = np.asanyarray(img.dataobj[box[0], box[1], start:stop])
+            if values is None:
+                values = np.empty(len(index[0]), data.dtype)
+            chunk = (index[2] >= start) & (index[2] < stop)
+            values[chunk] = data[local[0][chunk], local[1][chunk],
+                                 index[2][chunk] - start]
+        return values
+    for start in range(0, img.shape[3], SAMPLE_CHUNK_SIZE):
+        stop = min(start + SAMPLE_CHUNK_SIZE, img.shape[3])
+        data = np.asanyarray(img.dataobj[box + (slice(start, stop),)])
+        if values is None:
+            values = np.empty((len(index[0]), img.shape[3]), data.dtype)
+        values[:, start:stop] = data[local]
+    return values
+
+def _sample_img(img, voxel_coords, interpolation='nearest'):
+    """
+    returns the values of img at voxel_coords (N, 3), NaN outside of the
+    volume, with nearest or trilinear ('linear') interpolation.
+    The values of 4D images have one column per volume.
+    """
+    shape = np.array(img.shape[:3])
+    values = np.full((len(voxel_coords),) + img.shape[3:], np.nan)
+    if interpolation == 'nearest':
+        index = np.round(voxel_coords).astype(int)
+        inside = np.all((index >= 0) & (index < shape), axis=1)
+        if inside.any():
+            values[inside] = _values_at_voxels(img, index[inside])
+    elif interpolation == 'linear':
+        # tolerance for the rounding errors of the affine on the borders
+        inside = np.all((voxel_coords >= -1e-6) &
+                        (voxel_coords <= shape - 1 + 1e-6), axis=1)
+        if inside.any():
+            coords = np.clip(voxel_coords[inside], 0, shape - 1)
+            low = np.maximum(np.minimum(np.floor(coords).astype(int),
+                                        shape - 2), 0)
+            weights = coords - low
+            corners = np.array(list(itertools.product([0, 1], repeat=3)))
+            index = np.minimum(low[np.newaxis] + corners[:, np.newaxis],
+                               shape - 1)
+            corner_values = _values_at_voxels(img, index.reshape(-1, 3))
+            corner_values = corner_values.reshape(index.shape[:2] +
+                                                  img.shape[3:])
+            corner_weights = np.prod(np.where(corners[:, np.newaxis],
+                                              weights[np.newaxis],
+                                              1 - weights[np.newaxis]),
+                                     axis=2)
+            corner_weights = corner_weights.reshape(
+                corner_weights.shape + (1,) * (len(img.shape) - 3))
+            values[inside] = (corner_weights * corner_values).sum(axis=0)
+    else:
+        raise ValueError("unknown interpolation %s, use 'nearest' or "
+                         "'linear'" % interpolation)
+    return values
+
+def sample_values_in_mm(vols, mm_coords, interpolation='nearest'):
+    """
+    Get the values of images at coordinates in mm
+    vols: list of M img files, of the same number of volumes if 4D
+    mm_coords: list of N [x, y, z] coordinates in mm
+    interpolation: 'nearest' or 'linear' (trilinear)
+    Returns an array (M, N), or (M, N, volumes) for 4D images, NaN for
+    coordinates outside of an image. Each affine is inverted once, all the
+    coordinates converted at once, and only the voxels at the coordinates
+    are read from uncompressed images (see _values_at_voxels).
+    """
+    mm_coords = np.asarray(mm_coords, dtype=float).reshape(-1, 3)
+    values = []
+    for vol in vols:
+        voxel_coords = _mm_to_voxel(image_metadata(vol)['affine'], mm_coords)
+        values.append(_sample_img(nibabel.load(vol), voxel_coords,
+                                  interpolation))
+    return np.array(values)
+
+def get_value_in_mm(vol, mm_x, mm_y, mm_z, interpolation='nearest'):
     """
     Get the value of one voxel by giving the coord in mm
+    (see sample_values_in_mm)
     Example :
     utils.get_value_in_mm("T1.nii", 90., -126.,  -72.)
     0.013717801310122013
     """
-    img = nibabel.load(vol)
-    data = img.get_data()
-    coords_voxel = mm_to_voxel(vol, [[mm_x, mm_y, mm_z]])
-    value = data[coords_voxel[0][0], coords_voxel[0][1], coords_voxel[0][2]]
-    return value
+    return sample_values_in_mm([vol], [[mm_x, mm_y, mm_z]],
+                               interpolation)[0, 0]
     
     
 #######################
@@ -361,51 +878,200 @@ def cube(file_roi, vol, mm_x=0, mm_y=0, mm_z=0, width=3, dtype=np.uint8):
 #    #return np.ones((width, width, width), dtype=dtype)
 
 
+def _sphere_box(affine, shape, center_mm, radius):
+    """
+    returns the box of voxels around a sphere of radius mm (slices clipped
+    to shape), the distances in mm of the voxels of the box to the center
+    of the sphere and the mask of the voxels of the sphere in the box,
+    which always includes the voxel of the center.
+    The box is None if the sphere is outside of the volume.
+    """
+    center_mm = np.asarray(center_mm, dtype=float)
+    inv = np.linalg.inv(affine)
+    center = inv[:3, :3].dot(center_mm) + inv[:3, 3]
+    # largest extent of the sphere along each voxel axis
+    extent = radius * np.sqrt((inv[:3, :3] ** 2).sum(axis=1))
+    low = np.maximum(np.floor(center - extent).astype(int), 0)
+    high = np.minimum(np.ceil(center + extent).astype(int) + 1, shape[:3])
+    if np.any(high <= low):
+        return None, None, None
+    box = tuple(slice(l, h) for l, h in zip(low, high))
+    grid = np.mgrid[box].astype(float)
+    mm = (np.tensordot(affine[:3, :3], grid, axes=1) +
+          affine[:3, 3].reshape(3, 1, 1, 1))
+    dist = np.sqrt(((mm - center_mm.reshape(3, 1, 1, 1)) ** 2).sum(axis=0))
+    inside = dist <= radius
+    nearest = np.round(center).astype(int) - low
+    if np.all(nearest >= 0) and np.all(nearest < high - low):
+        inside[tuple(nearest)] = True
+    return box, dist, inside
+
+
 def sphere(file_roi, vol, mm_x=0, mm_y=0, mm_z=0, radius=4, dtype=np.uint8):
-    img = nibabel.load(vol)
-    header = img.get_header()
-    voxels_size= header.get_zooms()
-    coord_center_voxel = mm_to_voxel(vol, [[mm_x, mm_y, mm_z]])    
-    shape_x, shape_y, shape_z = img.shape[0], img.shape[1], img.shape[2]
-    roi = np.zeros((shape_x, shape_y, shape_z))
-    
-    radius = radius / voxels_size[0]
-    if radius > 1 :
-       radius -= 1 
+    """
+    write in file_roi a mask, in the space of vol, of the voxels within
+    radius mm of (mm_x, mm_y, mm_z) and of the voxel of this point.
+    Only the header of vol is read. Distances are computed in mm from the
+    affine, so anisotropic voxels are handled, and the sphere is clipped
+    to the volume.
+    """
+    metadata = image_metadata(vol)
+    shape = metadata['shape'][:3]
+    roi = np.zeros(shape, dtype)
+    box, _, inside = _sphere_box(metadata['affine'], shape,
+                                 [mm_x, mm_y, mm_z], radius)
+    if box is not None:
+        roi[box] = inside
+    nibabel.save(nibabel.Nifti1Image(roi, metadata['affine']), file_roi)
+
+
+def sphere_atlas(file_atlas, vol, coords_mm, radius=4, labels=None):
+    """
+    write in file_atlas a label image, in the space of vol, of the spheres
+    (see sphere) around each coordinate of coords_mm, [[x, y, z], ...].
+    labels: positive integer label of each sphere, by default 1 to N
+    A voxel in several spheres gets the label of the closest center. The
+    image has the smallest unsigned integer type holding the labels.
+    """
+    metadata = image_metadata(vol)
+    shape = metadata['shape'][:3]
+    if labels is None:
+        labels = np.arange(1, len(coords_mm) + 1)
+    labels = np.asarray(labels)
+    assert len(labels) == len(coords_mm) and np.all(labels > 0)
+    dtype = np.min_scalar_type(labels.max()) if len(labels) else np.uint8
+    atlas = np.zeros(shape, dtype)
+    closest = np.full(shape, np.inf, dtype=np.float32)
+    for label, center in zip(labels, coords_mm):
+        box, dist, inside = _sphere_box(metadata['affine'], shape, center,
+                                        radius)
+        if box is None:
+            continue
+        closer = inside & (dist < closest[box])
+        closest[box][closer] = dist[closer]
+        atlas[box][closer] = label
+    nibabel.save(nibabel.Nifti1Image(atlas, metadata['affine']), file_atlas)
+
+
+def voxel(file_roi, vol, mm_x=0, mm_y=0, mm_z=0, dtype=np.uint8):
+    """
+    write in file_roi a mask, in the space of vol, of the voxel of
+    (mm_x, mm_y, mm_z). Only the header of vol is read.
+    """
+    metadata = image_metadata(vol)
+    roi = np.zeros(metadata['shape'][:3], dtype)
+    coord_voxel = np.round(mm_to_voxel(vol, [mm_x, mm_y, mm_z])).astype(int)
+    roi[tuple(coord_voxel)] = 1
+    nibabel.save(nibabel.Nifti1Image(roi, metadata['affine']), file_roi)
 
-    first_x = coord_center_voxel[0][0] - radius
-    first_y = coord_center_voxel[0][1] - radius
-    first_z = coord_center_voxel[0][2] - radius
 
-    elem = morphology.ball(radius)
-    
-    #check voxel size is isotropic
-    #check radius is at least one voxel
-    for x in range(0,elem.shape[0]):
-            for y in range(0, elem.shape[1]):
-                    for z in range(0, elem.shape[2]):
-                        x_ = int(first_x) + x
-                        y_ = int(first_y) + y
-                        z_ = int(first_z) + z
-                        roi[x_, y_, z_] = elem[x,y,z]
-  
-    roi_img = nibabel.Nifti1Image(roi, img.get_affine(),img.get_header() )
-    nibabel.save(roi_img, file_roi)
-
-
-def voxel(file_roi, vol, mm_x=0, mm_y=0, mm_z=0):
-    img = nibabel.load(vol)
-    header = img.get_header()
-    voxels_size= header.get_zooms()
-    data = img.get_data()
-    coord_first_voxel = mm_to_voxel(vol, [[mm_x, mm_y, mm_z]])    
-    shape_x, shape_y, shape_z = img.shape[0], img.shape[1], img.shape[2]
-    roi = np.zeros((shape_x, shape_y, shape_z))
-    x_ = coord_first_voxel[0][0]
-    y_ = coord_first_voxel[0][1]
-    z_ = coord_first_voxel[0][2]
-    roi[int(x_) , int(y_), int(z_)] = 1
-    roi_img = nibabel.Nifti1Image(roi, img.get_affine(),img.get_header() )
-    nibabel.save(roi_img, file_roi)
 
 
+################
+# IMAGE ALGEBRA
+################
+
+# Number of z planes (3D result) or volumes (4D result) read at once
+IMAGE_MATH_CHUNK_SIZE = 16
+
+
+def _image_math_shape(imgs):
+    """
+    returns the affine and the shape of the result of image_math on the
+    img files of the dict imgs, after checking that they are compatible
+    """
+    names = sorted(imgs)
+    metadata = dict((name, image_metadata(imgs[name])) for name in names)
+    ref = metadata[names[0]]
+    n_volumes = set()
+    for name in names:
+        shape = metadata[name]['shape']
+        if len(shape) not in (3, 4) or shape[:3] != ref['shape'][:3]:
+            raise ValueError("%s has shape %s, %s has shape %s"
+                             % (name, shape, names[0], ref['shape']))
+        if not np.allclose(metadata[name]['affine'], ref['affine'],
+                           atol=1e-5):
+            raise ValueError("%s and %s have different affines"
+                             % (name, names[0]))
+        if len(shape) == 4:
+            n_volumes.add(shape[3])
+    if len(n_volumes) > 1:
+        raise ValueError("the 4D images have different numbers of volumes: "
+                         "%s" % sorted(n_volumes))
+    return ref['affine'], ref['shape'][:3] + tuple(n_volumes)
+
+
+def image_math(expression, imgs, file_out, chunk_size=IMAGE_MATH_CHUNK_SIZE,
+               dtype=None):
+    """
+    evaluate expression voxel-wise over img files and write the result in
+    file_out, chunk by chunk, so that the images are never held in memory.
+
+    expression: numpy expression of the names of imgs, e.g. 'a * b' or
+                'np.where(mask > 0, a, 0)', or function called with the
+                chunks of imgs as keyword arguments
+    imgs: dict names -> img files, with the same affine and the same 3D
+          shape; the 4D ones must have the same number of volumes
+    chunk_size: number of z planes (3D result) or volumes (4D result) read
+                at once in each image. The 3D images of a 4D result are read
+                whole.
+    dtype: dtype of file_out, by default the dtype of the result (uint8 for
+           a boolean result)
+    returns file_out
+    The affine and shapes are checked from the headers before any voxel is
+    read. file_out (.nii or .nii.gz) is written with the header of the
+    first 4D image (the first image for a 3D result) in the order of the
+    names, followed by the chunks in order.
+    """
+    if not imgs:
+        raise ValueError("no image to compute %s" % expression)
+    if op.abspath(file_out) in [op.abspath(f) for f in imgs.values()]:
+        raise ValueError("%s is also an input of image_math" % file_out)
+    affine, shape = _image_math_shape(imgs)
+    if callable(expression):
+        evaluate = lambda chunks: expression(**chunks)
+    else:
+        code = compile(expression, '<image_math>', 'eval')
+        evaluate = lambda chunks: eval(code, {'__builtins__': {}, 'np': np},
+                                       chunks)
+
+    proxies = dict((name, nibabel.load(f)) for name, f in imgs.items())
+    ref = sorted(name for name in proxies
+                 if proxies[name].shape == shape)[0]
+    whole = {}
+    if len(shape) == 4:
+        # the 3D images are broadcast along time
+        whole = dict((name, np.asanyarray(img.dataobj)[..., np.newaxis])
+                     for name, img in proxies.items() if len(img.shape) == 3)
+
+    def chunks():
+        for start in range(0, shape[-1], chunk_size):
+            stop = min(start + chunk_size, shape[-1])
+            values = dict((name, img.dataobj[..., start:stop])
+                          for name, img in proxies.items()
+                          if name not in whole)
+            values.update(whole)
+            yield np.broadcast_to(evaluate(values),
+                                  shape[:-1] + (stop - start,))
+
+    results = chunks()
+    first = next(results, None)
+    if dtype is None:
+        dtype = np.float64 if first is None else first.dtype
+        if dtype == np.bool_:
+            dtype = np.uint8
+    # the result is written raw: no scaling, data right after the header
+    header = nibabel.Nifti1Image(np.zeros((1, 1, 1), np.uint8), affine,
+                                 proxies[ref].header).header
+    header.set_data_shape(shape)
+    header.set_zooms(proxies[ref].header.get_zooms())
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(1, 0)
+    header['vox_offset'] = 0
+    dtype = header.get_data_dtype()
+    with nibabel.openers.ImageOpener(file_out, 'wb') as fid:
+        header.write_to(fid)
+        for result in itertools.chain([first] if first is not None else [],
+                                      results):
+            fid.write(np.asarray(result, dtype).tobytes(order='F'))
+    return file_out